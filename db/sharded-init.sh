@@ -0,0 +1,29 @@
+#!/bin/sh
+set -e
+
+wait_for() {
+    until mongosh --quiet --host "$1" --eval "db.adminCommand('ping')" > /dev/null 2>&1; do
+        sleep 1
+    done
+}
+
+init_replica_set() {
+    wait_for "$2"
+    mongosh --quiet --host "$2" --eval "
+        try { rs.status() } catch (e) {
+            rs.initiate({'_id': '$1', $3 'members': [{'_id': 0, 'host': '$2'}]})
+        }"
+    until mongosh --quiet --host "$2" --eval "quit(db.hello().isWritablePrimary ? 0 : 1)" > /dev/null 2>&1; do
+        sleep 1
+    done
+}
+
+init_replica_set cfg db-cfg:27017 "'configsvr': true,"
+init_replica_set shard1 db-shard1:27017
+init_replica_set shard2 db-shard2:27017
+
+wait_for db-mongos:27017
+mongosh --quiet --host db-mongos:27017 --eval "
+    sh.addShard('shard1/db-shard1:27017');
+    sh.addShard('shard2/db-shard2:27017');
+    printjson(db.adminCommand({listShards: 1}).shards)"
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from datafiles import format_file_size, strip_arr
+from memory import RssSampler
+from reader import read_header, PARSERS, READERS, BLOCK_SIZE
+from schema import build_schema, make_values, RowBatch, REGIONS, STATUSES
+from user import get_env, get_env_size, parse_size, print_err, print_flush, run_workers, use_env_files
+
+BENCH_YEAR = 2019
+SUBJECTS = ["Ukr", "hist", "math", "phys", "chem", "bio", "geo", "eng", "fra", "deu", "spa"]
+SUBJECT_COLUMNS = ["Test", "Lang", "TestStatus", "Ball100", "Ball12", "Ball", "PTName", "PTRegName",
+                   "PTAreaName", "PTTerName"]
+ZNO_HEADER = ["OUTID", "Birth", "SEXTYPENAME", "REGNAME", "AREANAME", "TERNAME", "REGTYPENAME", "TerTypeName",
+              "ClassProfileNAME", "ClassLangName", "EONAME", "EOTYPENAME", "EORegName", "EOAreaName",
+              "EOTerName", "EOParent"] + [s + c for s in SUBJECTS for c in SUBJECT_COLUMNS]
+
+
+def generate_row(rnd):
+    region = rnd.choice(REGIONS[:25])
+    row = [str(uuid.UUID(int=rnd.getrandbits(128))), str(rnd.randint(1995, 2004)),
+           rnd.choice(["чоловіча", "жіноча"]), region, "м.Херсон", "Дніпровський район у місті",
+           "місто", "місто", "Універсальний", "українська", "Херсонська загальноосвітня школа І-ІІІ ступенів",
+           "загальноосвітній навчальний заклад", region, "м.Херсон", "Дніпровський район у місті",
+           "Управління освіти Херсонської міської ради"]
+    for subject in SUBJECTS:
+        if rnd.random() < 0.4:
+            ball100 = rnd.randint(100, 200)
+            row += [subject, "українська", rnd.choice(STATUSES), f"{ball100},0", str(ball100 // 17),
+                    str(rnd.randint(0, 60)), "Пункт тестування №1", region, "м.Херсон", "Дніпровський район"]
+        else:
+            row += ["null"] * len(SUBJECT_COLUMNS)
+    return row
+
+
+def generate_datafile(path, size, encoding, broken_every=500, seed=0):
+    rnd = random.Random(seed)
+    with open(path, "w", encoding=encoding, newline="") as f:
+        f.write(";".join(f'"{h}"' for h in ZNO_HEADER) + "\n")
+        i = 0
+        while i % 100 or f.tell() < size:
+            line = ";".join(f'"{v}"' for v in generate_row(rnd))
+            if broken_every and i % broken_every == broken_every - 1:
+                cut = rnd.randint(1, len(line) - 1)
+                line = line[:cut] + "\n" + line[cut:]
+            f.write(line + "\n")
+            i += 1
+    return path
+
+
+def read_row_batches(file, encoding, parse, read_blocks, typed, batch_size=None, block_size=BLOCK_SIZE):
+    header_text, file_seek = read_header(file, encoding)
+    header = tuple(h.upper() for h in strip_arr(header_text.split(';')))
+    schema = build_schema(header) if typed else None
+    rows = RowBatch(header)
+    for lines, offsets in parse(read_blocks(file, file_seek, block_size), len(header), encoding, file_seek):
+        for line, offset in zip(lines, offsets):
+            rows.append(line if schema is None else make_values(line, schema), f"bench:{offset}", BENCH_YEAR)
+            if batch_size is not None and len(rows) >= batch_size:
+                yield rows
+                rows = RowBatch(header)
+        if batch_size is None:
+            yield rows
+            rows = RowBatch(header)
+    if rows:
+        yield rows
+
+
+def bench_parse(path, encoding, parser, reader, typed, block_size=BLOCK_SIZE):
+    rows = 0
+    started = time.perf_counter()
+    with open(path, "rb") as file:
+        for batch in read_row_batches(file, encoding, PARSERS[parser], READERS[reader], typed, block_size=block_size):
+            rows += len(batch.documents())
+    return rows, time.perf_counter() - started
+
+
+def get_bench_client(mongo):
+    if mongo == "mongomock":
+        import mongomock
+        return mongomock.MongoClient()
+    from populate import Populate
+    populate = Populate()
+    populate.db.connect()
+    return populate.db.client
+
+
+def bench_insert(client, db_name, path, encoding, batch_size, ordered):
+    collection = client[db_name]["bench_insert"]
+    collection.drop()
+    rows, elapsed = 0, 0
+    with open(path, "rb") as file:
+        for batch in read_row_batches(file, encoding, PARSERS["block"], READERS["buffered"], False, batch_size):
+            documents = batch.documents()
+            started = time.perf_counter()
+            collection.insert_many(documents, ordered=ordered)
+            elapsed += time.perf_counter() - started
+            rows += len(documents)
+    collection.drop()
+    return rows, elapsed
+
+
+def bench_end_to_end(data_folder):
+    from db import db_session
+    from populate import Populate
+    use_env_files()
+    os.environ["DATA_FOLDER"] = data_folder
+    os.environ["TARGET_COLLECTION_NAME"] = "bench_znorecords"
+    os.environ["AUX_COLLECTION_NAME"] = "bench_znorecords_aux"
+    os.environ["SUMMARY_COLLECTION_NAME"] = "bench_znorecords_summary"
+    os.environ["MANIFEST_COLLECTION_NAME"] = "bench_znorecords_manifest"
+    populate = Populate()
+    with populate:
+        populate.drop_target()
+        populate.drop_aux()
+        started = time.perf_counter()
+        with RssSampler() as rss:
+            populate.prepare()
+            populate.start()
+        elapsed = time.perf_counter() - started
+
+        @db_session(transaction=False)
+        def _count(session, db):
+            return populate.get_target_collection(session, db).estimated_document_count()
+
+        rows = _count(populate)
+        populate.drop_target()
+        populate.drop_summary()
+        populate.drop_manifest()
+    return rows, elapsed, rss.peak
+
+
+def run_isolated(func, *args):
+    return run_workers(func, [args], 1)[0]
+
+
+def result(kind, path, rows, elapsed, **params):
+    size = os.path.getsize(path) if os.path.isfile(path) else \
+        sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return dict(kind=kind, file_size=size, rows=rows, seconds=round(elapsed, 4),
+                rows_per_s=round(rows / elapsed, 1) if elapsed else None,
+                mb_per_s=round(size / elapsed / (1 << 20), 2) if elapsed else None, **params)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingestion benchmark on synthetic ZNO datafiles")
+    parser.add_argument("--sizes", default="10MB", help="comma separated datafile sizes, e.g. 10MB,1GB")
+    parser.add_argument("--encodings", default="cp1251,utf-8-sig")
+    parser.add_argument("--parsers", default=",".join(PARSERS))
+    parser.add_argument("--readers", default=",".join(READERS))
+    parser.add_argument("--schemas", default="raw,typed")
+    parser.add_argument("--insert", action="store_true", help="also measure insert-only throughput")
+    parser.add_argument("--end-to-end", action="store_true", help="also measure a full Populate run")
+    parser.add_argument("--mongo", default="env", choices=["env", "mongomock"],
+                        help="database for --insert: MONGO_* settings or an in-memory mongomock stand-in")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--memory-budget", default=None,
+                        help="POPULATE_MEMORY_BUDGET for --end-to-end, fail if the peak RSS exceeds it")
+    parser.add_argument("--workdir", default=None, help="where to generate datafiles (temporary by default)")
+    parser.add_argument("--output", default=None, help="JSON result file (QUERY_FOLDER/bench_result.json by default)")
+    args = parser.parse_args(argv)
+
+    use_env_files()
+    if args.output is None:
+        args.output = os.path.join(get_env("QUERY_FOLDER", required=False) or ".", "bench_result.json")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="zno-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    if args.memory_budget is not None:
+        os.environ["POPULATE_MEMORY_BUDGET"] = args.memory_budget
+    budget = get_env_size("POPULATE_MEMORY_BUDGET", 0)
+    over_budget = []
+    try:
+        for size in [parse_size(s) for s in args.sizes.split(",")]:
+            for encoding in args.encodings.split(","):
+                folder = os.path.join(workdir, f"{size}-{encoding}")
+                os.makedirs(folder, exist_ok=True)
+                path = os.path.join(folder, f"Odata2019File.{encoding}.csv")
+                if not os.path.exists(path):
+                    print_flush(f"Generating {format_file_size(size)} {encoding} datafile...")
+                    generate_datafile(path, size, encoding)
+                for parser_name in args.parsers.split(","):
+                    for reader in args.readers.split(","):
+                        for schema in args.schemas.split(","):
+                            rows, elapsed = bench_parse(path, encoding, parser_name, reader, schema == "typed")
+                            results.append(result("parse", path, rows, elapsed, encoding=encoding,
+                                                  parser=parser_name, reader=reader, schema=schema))
+                            print_flush(json.dumps(results[-1], ensure_ascii=False))
+                if args.insert:
+                    client = get_bench_client(args.mongo)
+                    for ordered in (True, False):
+                        rows, elapsed = bench_insert(client, get_env("MONGO_DBNAME", required=False) or "bench", path, encoding,
+                                                     args.batch_size, ordered)
+                        results.append(result("insert", path, rows, elapsed, encoding=encoding, mongo=args.mongo,
+                                              batch_size=args.batch_size, ordered=ordered))
+                        print_flush(json.dumps(results[-1], ensure_ascii=False))
+                if args.end_to_end:
+                    rows, elapsed, peak_rss = run_isolated(bench_end_to_end, folder)
+                    results.append(result("end_to_end", folder, rows, elapsed, encoding=encoding, peak_rss=peak_rss,
+                                          **{k: v for k, v in os.environ.items() if k.startswith("POPULATE_")}))
+                    print_flush(json.dumps(results[-1], ensure_ascii=False))
+                    if budget and peak_rss > budget:
+                        over_budget.append(results[-1])
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(dict(timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), python=sys.version.split()[0],
+                       platform=platform.platform(), results=results), f, ensure_ascii=False, indent=2)
+    print_flush(f"Benchmark results written to '{args.output}'")
+    for item in over_budget:
+        print_err(f"Peak RSS {format_file_size(item['peak_rss'])} of end-to-end run on "
+                  f"{format_file_size(item['file_size'])} ({item['encoding']}) exceeds the memory budget "
+                  f"{format_file_size(budget)}!")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
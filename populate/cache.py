@@ -0,0 +1,155 @@
+import glob
+import os
+import re
+
+from datafiles import get_file_fingerprint, get_file_encoding, get_datafile_name, open_datafile, strip_arr
+from reader import read_header, read_blocks, parse_block
+from schema import build_schema, NULL_VALUES
+from user import panic, print_flush, run_workers, PANIC_DEPENDENCY_MISSING
+
+OFFSET_COLUMN = "__offset"
+ROW_GROUP_SIZE = 1 << 16
+CACHE_SUFFIX = ".parquet"
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        panic("POPULATE_CACHE requires the 'pyarrow' package (pip install pyarrow)!", PANIC_DEPENDENCY_MISSING)
+    return pyarrow, pyarrow.parquet
+
+
+def get_cache_name(file_name):
+    return re.sub(r"[^\w.-]", "_", get_datafile_name(file_name))
+
+
+def get_cache_path(cache_folder, file_name):
+    fingerprint = get_file_fingerprint(file_name)
+    return os.path.join(cache_folder, f"{get_cache_name(file_name)}.{fingerprint}{CACHE_SUFFIX}")
+
+
+def get_cache_file(cache_folder, file_name):
+    path = get_cache_path(cache_folder, file_name)
+    return path if os.path.exists(path) else None
+
+
+def read_records(file_name):
+    encoding = get_file_encoding(file_name)
+    with open_datafile(file_name) as file:
+        header_text, file_seek = read_header(file, encoding)
+        header = [h.upper() for h in strip_arr(header_text.split(';'))]
+        schema = build_schema(header)
+        yield header, schema, file_seek
+        for records, offsets in parse_block(read_blocks(file, file_seek), len(header), encoding, file_seek):
+            yield records, offsets
+
+
+def convert(value, converter):
+    if value in NULL_VALUES:
+        return None
+    return value if converter is None else converter(value)
+
+
+def get_kind(kind, value):
+    if value is None or kind == "raw":
+        return kind
+    value_kind = "int" if isinstance(value, int) else "float" if isinstance(value, float) else "raw"
+    if kind is None or kind == value_kind:
+        return value_kind
+    return "raw"
+
+
+def infer_kinds(file_name):
+    records = read_records(file_name)
+    header, schema, _ = next(records)
+    kinds = [None] * len(header)
+    for lines, _ in records:
+        for line in lines:
+            for i, (value, converter) in enumerate(zip(line, schema)):
+                if kinds[i] != "raw":
+                    kinds[i] = get_kind(kinds[i], convert(value, converter))
+    return [kind or "raw" for kind in kinds]
+
+
+def build_cache(cache_folder, file_name):
+    pa, pq = import_pyarrow()
+    path = get_cache_path(cache_folder, file_name)
+    if os.path.exists(path):
+        return path
+    os.makedirs(cache_folder, exist_ok=True)
+    kinds = infer_kinds(file_name)
+    records = read_records(file_name)
+    header, schema, header_end = next(records)
+    types = {"int": pa.int64(), "float": pa.float64(), "raw": pa.string()}
+    arrow_schema = pa.schema([pa.field(h, types[kind]) for h, kind in zip(header, kinds)] +
+                             [pa.field(OFFSET_COLUMN, pa.int64())],
+                             metadata={"header_end": str(header_end), "kinds": ",".join(kinds)})
+    converters = [None if kind == "raw" else converter for kind, converter in zip(kinds, schema)]
+    with pq.ParquetWriter(f"{path}.tmp", arrow_schema, compression="zstd") as writer:
+        columns, offsets = [[] for _ in header], []
+        for lines, line_offsets in records:
+            for line in lines:
+                for column, value, converter in zip(columns, line, converters):
+                    column.append(convert(value, converter))
+            offsets.extend(line_offsets)
+            if len(offsets) >= ROW_GROUP_SIZE:
+                writer.write_table(pa.Table.from_arrays(columns + [offsets], schema=arrow_schema))
+                columns, offsets = [[] for _ in header], []
+        if offsets:
+            writer.write_table(pa.Table.from_arrays(columns + [offsets], schema=arrow_schema))
+    os.replace(f"{path}.tmp", path)
+    pattern = f"{glob.escape(get_cache_name(file_name))}.*{CACHE_SUFFIX}"
+    for old_path in glob.glob(os.path.join(glob.escape(cache_folder), pattern)):
+        if old_path != path:
+            os.remove(old_path)
+    return path
+
+
+def build_caches(cache_folder, file_names, workers=1):
+    import_pyarrow()
+    missing = [file_name for file_name in file_names if get_cache_file(cache_folder, file_name) is None]
+    if not missing:
+        return
+    print_flush(f"Caching {len(missing)} file(s) into '{cache_folder}': ", end="")
+    if workers > 1 and len(missing) > 1:
+        run_workers(build_cache, [(cache_folder, file_name) for file_name in missing], min(workers, len(missing)))
+    else:
+        for file_name in missing:
+            build_cache(cache_folder, file_name)
+    print_flush("done!")
+
+
+def read_cache(path, file_seek, file_end=None, batch_size=ROW_GROUP_SIZE):
+    _, pq = import_pyarrow()
+    file = pq.ParquetFile(path)
+    metadata = file.schema_arrow.metadata
+    kinds = metadata[b"kinds"].decode().split(",")
+    header = file.schema_arrow.names[:-1]
+    offset_index = len(header)
+    schema = build_schema(header)
+    converters = [converter if kind == "raw" else None for kind, converter in zip(kinds, schema)]
+    prev_offset = int(metadata[b"header_end"])
+    for i in range(file.metadata.num_row_groups):
+        statistics = file.metadata.row_group(i).column(offset_index).statistics
+        if statistics is not None and statistics.has_min_max and statistics.max <= file_seek:
+            prev_offset = statistics.max
+            continue
+        for batch in file.iter_batches(batch_size=batch_size, row_groups=[i]):
+            columns = [column.to_pylist() for column in batch.columns]
+            records, offsets = [], []
+            for row in zip(*columns):
+                offset = row[offset_index]
+                if file_end is not None and prev_offset >= file_end:
+                    if records:
+                        yield records, offsets
+                    return
+                prev_offset = offset
+                if offset <= file_seek:
+                    continue
+                records.append([value if converter is None or value is None else converter(value)
+                                for value, converter in zip(row, converters)])
+                offsets.append(offset)
+            if records:
+                yield records, offsets
@@ -1,34 +1,254 @@
+import bz2
+import codecs
+import gzip
+import hashlib
+import json
+import lzma
 import os
+import zipfile
+
+from user import panic, run_workers, PANIC_DEPENDENCY_MISSING
 
 DATA_FOLDER = "data"
 QUERY_FOLDER = "query"
 ENCODINGS = ["utf-8-sig", "cp1251", "utf-8"]
+STRIP_CHARS = "'\n\" "
+ENCODINGS_MANIFEST = ".encodings.json"
+DETECT_CHUNK_SIZE = 1 << 20
+FINGERPRINT_SAMPLE_SIZE = 1 << 20
+STREAM_CHUNK_SIZE = 1 << 16
+ARCHIVE_SEPARATOR = "::"
 
 
-def read_file(path):
-    b_enc, path_enc = os.path.splitext(os.path.splitext(path)[0])
-    path_enc = path_enc[1:]
-    guess_encodings = ENCODINGS
-    if path_enc in ENCODINGS:
-        guess_encodings = [path_enc] + [enc for enc in ENCODINGS if enc != path_enc]
-    for encoding in guess_encodings:
-        try:
-            with open(path, "r", encoding=encoding) as f:
-                lines = f.readlines()
-            if encoding != path_enc:
-                os.rename(path, f"{b_enc}.{encoding}.csv")
-            return lines
-        except UnicodeError:
+def open_zstd(path):
+    try:
+        import zstandard
+    except ImportError:
+        panic(f"Reading '{path}' requires the 'zstandard' package (pip install zstandard)!", PANIC_DEPENDENCY_MISSING)
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+
+COMPRESSIONS = {
+    ".gz": lambda path: gzip.open(path, "rb"),
+    ".bz2": lambda path: bz2.open(path, "rb"),
+    ".xz": lambda path: lzma.open(path, "rb"),
+    ".zst": open_zstd,
+}
+
+
+def split_archive_path(path):
+    if ARCHIVE_SEPARATOR in path:
+        container, member = path.split(ARCHIVE_SEPARATOR, 1)
+        return container, member
+    return path, None
+
+
+def get_container_path(path):
+    return split_archive_path(path)[0]
+
+
+def get_compression(path):
+    container, member = split_archive_path(path)
+    if member is not None:
+        return ".zip"
+    extension = os.path.splitext(container)[1]
+    return extension if extension in COMPRESSIONS else None
+
+
+def is_compressed(path):
+    return get_compression(path) is not None
+
+
+def get_datafile_name(path):
+    container, member = split_archive_path(path)
+    name = os.path.basename(container)
+    return name if member is None else f"{name}{ARCHIVE_SEPARATOR}{member}"
+
+
+def strip_compression(path):
+    container, member = split_archive_path(path)
+    if member is not None:
+        return member
+    compression = get_compression(path)
+    return path if compression is None else path[:-len(compression)]
+
+
+def open_zip_member(container, member):
+    with zipfile.ZipFile(container) as archive:
+        return archive.open(member)
+
+
+class CompressedFile:
+    compressed = True
+
+    def __init__(self, name):
+        self.name = name
+        container, member = split_archive_path(name)
+        if member is not None:
+            self.opener = lambda: open_zip_member(container, member)
+        else:
+            self.opener = lambda: COMPRESSIONS[get_compression(name)](container)
+        self.stream = self.opener()
+        self.position = 0
+        self.buffer = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        self.close()
+
+    def close(self):
+        self.stream.close()
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self.buffer = self.buffer + self.stream.read(), b""
+        elif len(self.buffer) >= size:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        else:
+            data, self.buffer = self.buffer + self.stream.read(size - len(self.buffer)), b""
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        while True:
+            end = self.buffer.find(b"\n") + 1
+            if end:
+                break
+            chunk = self.stream.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                end = len(self.buffer)
+                break
+            self.buffer += chunk
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        self.position += len(line)
+        return line
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise OSError("Compressed datafiles only support absolute seeks")
+        if offset < self.position:
+            self.stream.close()
+            self.stream = self.opener()
+            self.position = 0
+            self.buffer = b""
+        while self.position < offset and self.read(min(offset - self.position, STREAM_CHUNK_SIZE)):
             pass
-    raise UnicodeError(f"Cannot decode file, tried encodings: {', '.join(ENCODINGS)}")
+        return self.position
+
+
+def open_datafile(path):
+    if is_compressed(path):
+        return CompressedFile(path)
+    return open(path, "rb")
+
+
+def guess_encodings(path):
+    path_enc = os.path.splitext(os.path.splitext(strip_compression(path))[0])[1][1:]
+    if path_enc in ENCODINGS:
+        return [path_enc] + [enc for enc in ENCODINGS if enc != path_enc]
+    return ENCODINGS
+
+
+def scan_datafile(path, chunk_size=DETECT_CHUNK_SIZE):
+    candidates = [(encoding, codecs.getincrementaldecoder(encoding)()) for encoding in guess_encodings(path)]
+    data_size = 0
+    with open_datafile(path) as f:
+        while candidates or is_compressed(path):
+            chunk = f.read(chunk_size)
+            data_size += len(chunk)
+            alive = []
+            for encoding, decoder in candidates:
+                try:
+                    decoder.decode(chunk, not chunk)
+                    alive.append((encoding, decoder))
+                except UnicodeError:
+                    pass
+            candidates = alive
+            if not chunk:
+                break
+    if not candidates:
+        raise UnicodeError(f"Cannot decode file '{path}', tried encodings: {', '.join(ENCODINGS)}")
+    return dict(encoding=candidates[0][0], data_size=data_size if is_compressed(path) else None)
+
+
+def get_file_stamp(path):
+    stat = os.stat(get_container_path(path))
+    return dict(size=stat.st_size, mtime=stat.st_mtime)
+
+
+def get_file_fingerprint(path, sample_size=FINGERPRINT_SAMPLE_SIZE):
+    container, member = split_archive_path(path)
+    size = os.path.getsize(container)
+    digest = hashlib.blake2b(f"{size}{ARCHIVE_SEPARATOR}{member or ''}".encode(), digest_size=16)
+    with open(container, "rb") as f:
+        for offset in sorted({0, max(0, size // 2 - sample_size // 2), max(0, size - sample_size)}):
+            f.seek(offset)
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def read_encodings_manifest(folder):
+    try:
+        with open(os.path.join(folder, ENCODINGS_MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def read_manifest_entry(path):
+    entry = read_encodings_manifest(os.path.dirname(get_container_path(path))).get(get_datafile_name(path))
+    if entry is None or {k: entry.get(k) for k in ("size", "mtime")} != get_file_stamp(path):
+        return None
+    return entry
+
+
+def write_encodings_manifest(folder, scans):
+    manifest = read_encodings_manifest(folder)
+    for path, scan in scans.items():
+        manifest[get_datafile_name(path)] = dict(get_file_stamp(path), **scan)
+    manifest_path = os.path.join(folder, ENCODINGS_MANIFEST)
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def scan_datafiles(paths, workers=1):
+    if workers > 1 and len(paths) > 1:
+        scans = run_workers(scan_datafile, [(path,) for path in paths], min(workers, len(paths)))
+    else:
+        scans = [scan_datafile(path) for path in paths]
+    return dict(zip(paths, scans))
 
 
 def get_file_encoding(path):
-    return os.path.splitext(os.path.splitext(path)[0])[1][1:]
+    encoding = os.path.splitext(os.path.splitext(strip_compression(path))[0])[1][1:]
+    if encoding:
+        return encoding
+    entry = read_manifest_entry(path)
+    if entry is None:
+        return ""
+    return entry["encoding"]
+
+
+def get_data_size(path):
+    container, member = split_archive_path(path)
+    if member is not None:
+        with zipfile.ZipFile(container) as archive:
+            return archive.getinfo(member).file_size
+    if not is_compressed(path):
+        return os.path.getsize(path)
+    entry = read_manifest_entry(path)
+    return None if entry is None else entry.get("data_size")
 
 
 def get_file_size(path):
-    return os.path.getsize(path)
+    size = get_data_size(path)
+    return scan_datafile(path)["data_size"] if size is None else size
 
 
 def format_file_size(b):
@@ -59,9 +279,18 @@ def parse_year(filename):
 
 def get_datafiles_list(path):
     data_files, data_files_years = [], dict()
+    files = []
     for file in os.listdir(path):
-        if file.endswith(".csv"):
-            year = parse_year(os.path.splitext(os.path.splitext(file)[0])[0])
+        if file.endswith(".zip"):
+            with zipfile.ZipFile(os.path.join(path, file)) as archive:
+                files.extend(f"{file}{ARCHIVE_SEPARATOR}{member}" for member in archive.namelist()
+                             if member.endswith(".csv"))
+        else:
+            files.append(file)
+    for file in files:
+        name = os.path.basename(strip_compression(file))
+        if name.endswith(".csv"):
+            year = parse_year(os.path.splitext(os.path.splitext(name)[0])[0])
             if year is None:
                 data_files.append(os.path.join(path, file))
             else:
@@ -71,7 +300,7 @@ def get_datafiles_list(path):
 
 
 def strip(text):
-    return text.strip("'\n\" ")
+    return text.strip(STRIP_CHARS)
 
 
 def strip_arr(arr):
@@ -1,15 +1,32 @@
+import threading
+from contextlib import contextmanager
+
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+from indexes import build_indexes
+from metrics import timed
+from sharding import shard_collection
+from user import panic, PANIC_ENV_VAR_INVALID
 
+DUPLICATE_KEY_ERROR = 11000
 
-def db_session(func):
-    result = [None]
+
+def db_session(func=None, transaction=True):
+    if func is None:
+        return lambda f: db_session(f, transaction)
 
     def wrapper(*args):
+        result = [None]
+
         def callback(s):
-            result[0] = func(s, args[0].get_database(s))
+            result[0] = func(s, args[0].get_database(s), *args[1:])
 
         with args[0].get_session() as s:
-            s.with_transaction(callback)
+            if transaction:
+                s.with_transaction(callback)
+            else:
+                callback(s)
 
         return result[0]
 
@@ -22,8 +39,21 @@ class DbOperation:
         self.database = database
 
     def connect(self):
+        options = dict()
+        write_concern = self.database.auth.get("write_concern")
+        if write_concern is not None:
+            options["w"] = int(write_concern) if write_concern.isdigit() else write_concern
+            if options["w"] == 0:
+                panic("Unacknowledged write concern (w=0) cannot guarantee durable checkpoints!",
+                      PANIC_ENV_VAR_INVALID)
+        journal = self.database.auth.get("journal")
+        if journal is not None:
+            options["journal"] = journal.lower() in ("1", "true", "yes", "on")
+        pool_size = self.database.auth.get("pool_size")
+        if pool_size is not None:
+            options["maxPoolSize"] = int(pool_size)
         if self.database.auth.get("url") is not None:
-            self.database.client = MongoClient(self.database.auth["url"])
+            self.database.client = MongoClient(self.database.auth["url"], **options)
         else:
             port = self.database.auth.get("port")
             if port is not None:
@@ -33,40 +63,127 @@ class DbOperation:
                 port=port,
                 username=self.database.auth.get("username"),
                 password=self.database.auth.get("password"),
+                **options,
             )
 
-    def check_collection_exists(self, collection_name, operation_name="CHECK COLLECTION EXISTS"):
-        return collection_name in self.database.list_collection_names()
+    @timed
+    def get_existing_collections(self, collection_names, operation_name="GET EXISTING COLLECTIONS"):
+        return set(self.database.list_collection_names(
+            session=self.session, filter={"name": {"$in": list(collection_names)}}))
 
     def get_collection(self, collection_name, operation_name="CREATE COLLECTION"):
         return self.database[collection_name]
 
+    @timed
+    def create_collection(self, collection_name, operation_name="CREATE COLLECTION"):
+        return self.database.create_collection(collection_name, session=self.session)
+
+    @timed
+    def get_index_names(self, collection, operation_name="GET INDEX NAMES"):
+        return set(collection.index_information(session=self.session))
+
+    @timed
+    def create_indexes(self, collection, indexes, operation_name="CREATE INDEXES"):
+        return build_indexes(self.database.client, collection, indexes)
+
+    @timed
+    def shard_collection(self, collection, shard_key, split_points, operation_name="SHARD COLLECTION"):
+        return shard_collection(self.database.client, collection, shard_key, split_points)
+
+    @timed
     def drop_collection(self, collection, operation_name="DROP COLLECTION"):
         return collection.drop()
 
-    def insert_data(self, collection, data, operation_name="INSERT DATA", use_session=True):
+    def _insert_many(self, collection, data, use_session, ordered):
+        if use_session:
+            return collection.insert_many(data, ordered=ordered, session=self.session)
+        else:
+            return collection.insert_many(data, ordered=ordered)
+
+    @timed
+    def insert_data(self, collection, data, operation_name="INSERT DATA", use_session=True, ordered=True):
+        return self._insert_many(collection, data, use_session, ordered)
+
+    @timed
+    def insert_new_data(self, collection, data, operation_name="INSERT NEW DATA", use_session=True):
+        try:
+            self._insert_many(collection, data, use_session, ordered=False)
+            return data
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors") or \
+                    any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+            duplicates = {error["index"] for error in e.details["writeErrors"]}
+            return [row for i, row in enumerate(data) if i not in duplicates]
+
+    @timed
+    def bulk_write(self, collection, requests, operation_name="BULK WRITE", use_session=True, ordered=False):
         if use_session:
-            return collection.insert_many(data, session=self.session)
+            return collection.bulk_write(requests, ordered=ordered, session=self.session)
         else:
-            return collection.insert_many(data)
+            return collection.bulk_write(requests, ordered=ordered)
+
+    @timed
+    def aggregate(self, collection, pipeline, operation_name="AGGREGATE"):
+        return collection.aggregate(pipeline, allowDiskUse=True, session=self.session)
 
-    def update_data(self, collection, data, operation_name="UPDATE DATA"):
-        return collection.update({"_id": data["_id"]}, data)
+    @timed
+    def count_data(self, collection, query, operation_name="COUNT DATA"):
+        return collection.count_documents(query, session=self.session)
 
+    @timed
+    def update_fields(self, collection, query, update, operation_name="UPDATE FIELDS", upsert=False):
+        return collection.update_one(query, update, upsert=upsert, session=self.session)
+
+    @timed
     def delete_data(self, collection, data, operation_name="DELETE DATA"):
         return collection.delete_one({"_id": data["_id"]})
 
+    @timed
+    def delete_many_data(self, collection, query, operation_name="DELETE MANY DATA"):
+        return collection.delete_many(query, session=self.session)
+
     def close(self):
-        pass
+        if self.database.client is not None:
+            self.database.client.close()
+            self.database.client = None
 
 
 class Db:
     def __init__(self, auth):
         self.auth = auth
         self.client = None
+        self.sessions = threading.local()
+        self.open_sessions = set()
 
     def connect(self):
         DbOperation(None, self).connect()
 
     def disconnect(self):
+        for session in list(self.open_sessions):
+            session.end_session()
+        self.open_sessions.clear()
         DbOperation(None, self).close()
+
+    @contextmanager
+    def session(self):
+        if getattr(self.sessions, "busy", False):
+            with self.client.start_session() as session:
+                yield session
+            return
+        session = getattr(self.sessions, "session", None)
+        if session is None or session.has_ended or session.client is not self.client:
+            session = self.sessions.session = self.client.start_session()
+            self.open_sessions.add(session)
+        self.sessions.busy = True
+        try:
+            yield session
+        finally:
+            self.sessions.busy = False
+
+    def release_session(self):
+        session = getattr(self.sessions, "session", None)
+        if session is not None:
+            self.sessions.session = None
+            self.open_sessions.discard(session)
+            session.end_session()
@@ -0,0 +1,166 @@
+import csv
+import gzip
+import io
+import json
+import os
+
+from schema import get_codes, match_values
+
+EXPORT_FORMATS = ["csv", "jsonl", "zno"]
+EXPORT_PARTITIONS = ["year", "id"]
+EXPORT_COMPRESSIONS = ["gzip", "none"]
+SAMPLES_PER_PART = 32
+ZNO_NULL = "null"
+ZNO_SKIP_COLUMNS = {"_id", "year"}
+
+
+def export_filter(years=None, regions=None):
+    query = {"dummy": {"$exists": False}}
+    if years:
+        query["year"] = {"$in": list(years)}
+    if regions:
+        query["REGNAME"] = {"$in": [value for region in regions for value in match_values("REGNAME", region)]}
+    return query
+
+
+def columns_pipeline(query):
+    return [
+        {"$match": query},
+        {"$project": {"_id": 0, "keys": {"$map": {"input": {"$objectToArray": "$$ROOT"}, "in": "$$this.k"}}}},
+        {"$unwind": {"path": "$keys", "includeArrayIndex": "position"}},
+        {"$group": {"_id": "$keys", "position": {"$min": "$position"}}},
+        {"$sort": {"position": 1, "_id": 1}},
+    ]
+
+
+def order_columns(columns, headers):
+    present = set(columns)
+    ordered = [c for c in ("_id",) if c in present]
+    for header in headers:
+        ordered.extend(c for c in header if c in present and c not in ordered)
+    ordered.extend(c for c in columns if c not in ordered)
+    return ordered
+
+
+def years_pipeline(query):
+    return [
+        {"$match": query},
+        {"$group": {"_id": "$year"}},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+def id_sample_pipeline(query, parts):
+    return [
+        {"$match": query},
+        {"$sample": {"size": parts * SAMPLES_PER_PART}},
+        {"$project": {"_id": 1}},
+    ]
+
+
+def get_id_bounds(ids, parts):
+    ids = sorted(set(ids))
+    bounds = []
+    for i in range(1, parts):
+        point = ids[len(ids) * i // parts] if ids else None
+        if point is not None and (not bounds or point > bounds[-1]):
+            bounds.append(point)
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def partition_filter(query, entry, last_id=None):
+    query = dict(query)
+    if entry.get("partition") == "year":
+        query["year"] = entry["year"]
+    id_range = dict()
+    if entry.get("id_min") is not None:
+        id_range["$gte"] = entry["id_min"]
+    if entry.get("id_max") is not None:
+        id_range["$lt"] = entry["id_max"]
+    if last_id is not None:
+        id_range["$gt"] = last_id
+    if id_range:
+        query["_id"] = id_range
+    return query
+
+
+def get_export_path(folder, name, key, export_format, encoding, compression):
+    extension = ".jsonl" if export_format == "jsonl" else f".{encoding}.csv" if export_format == "zno" else ".csv"
+    if compression == "gzip":
+        extension += ".gz"
+    return os.path.join(folder, f"{name}_{key}{extension}")
+
+
+def get_decoders(columns):
+    decoders = dict()
+    for column in columns:
+        codes = get_codes(column)
+        if codes is not None:
+            decoders[column] = {code: name for name, code in codes.items()}
+    return decoders
+
+
+def format_zno_value(value):
+    if value is None:
+        return ZNO_NULL
+    if isinstance(value, float):
+        return str(value).replace(".", ",")
+    return str(value)
+
+
+class ExportWriter:
+    def __init__(self, path, export_format, columns, encoding, compression, file_size=0):
+        self.path = path
+        self.format = export_format
+        self.columns = [c for c in columns if c not in ZNO_SKIP_COLUMNS] if export_format == "zno" else columns
+        self.decoders = get_decoders(self.columns)
+        self.encoding = encoding if export_format == "zno" else "utf-8"
+        self.row_encoding = "utf-8" if self.encoding == "utf-8-sig" else self.encoding
+        self.compression = compression
+        self.size = file_size
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.file = open(self.path, "r+b" if self.size and os.path.exists(self.path) else "wb")
+        self.file.truncate(self.size)
+        self.file.seek(self.size)
+        if self.size == 0 and self.format != "jsonl":
+            self._write(self.format_header().encode(self.encoding))
+        return self
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        self.file.close()
+
+    def decode(self, document):
+        return {k: self.decoders[k].get(v, v) if k in self.decoders else v for k, v in document.items()}
+
+    def format_header(self):
+        if self.format == "zno":
+            return ";".join(f'"{c}"' for c in self.columns) + "\n"
+        text = io.StringIO()
+        csv.writer(text, lineterminator="\n").writerow(self.columns)
+        return text.getvalue()
+
+    def format_rows(self, documents):
+        if self.format == "jsonl":
+            return "".join(json.dumps(self.decode(d), ensure_ascii=False, default=str) + "\n" for d in documents)
+        if self.format == "zno":
+            return "".join(";".join(f'"{format_zno_value(d.get(c))}"' for c in self.columns) + "\n"
+                           for d in map(self.decode, documents))
+        text = io.StringIO()
+        csv.writer(text, lineterminator="\n").writerows([d.get(c) for c in self.columns]
+                                                        for d in map(self.decode, documents))
+        return text.getvalue()
+
+    def write(self, documents):
+        self._write(self.format_rows(documents).encode(self.row_encoding))
+        return self.size
+
+    def _write(self, data):
+        if self.compression == "gzip":
+            data = gzip.compress(data)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(data)
@@ -10,11 +10,15 @@ class Fs:
         self.query_folder = get_env("QUERY_FOLDER")
         self.schema = None
         self.data_files = None
+        self.data_folder_mtime = None
 
     def connect(self):
         if not os.path.exists(self.data_folder):
             panic(f"Data folder '{self.data_folder}' doesn't exist!", PANIC_DATA_FOLDER_DOESNT_EXIST)
-        self.data_files = get_datafiles_list(self.data_folder)
+        mtime = os.stat(self.data_folder).st_mtime_ns
+        if self.data_files is None or mtime != self.data_folder_mtime:
+            self.data_files = get_datafiles_list(self.data_folder)
+            self.data_folder_mtime = mtime
 
     def disconnect(self):
         pass
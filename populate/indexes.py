@@ -0,0 +1,76 @@
+import threading
+
+from pymongo import IndexModel, ASCENDING
+
+from user import print_flush
+
+INDEXES = [
+    IndexModel([("year", ASCENDING), ("PHYSTESTSTATUS", ASCENDING), ("REGNAME", ASCENDING),
+                ("PHYSBALL100", ASCENDING)],
+               name="year_physteststatus_regname_physball100",
+               partialFilterExpression={"PHYSTESTSTATUS": {"$exists": True}}),
+]
+PROGRESS_INTERVAL = 2
+
+
+def get_index_name(index):
+    return index.document["name"]
+
+
+def get_missing_indexes(index_names):
+    return [index for index in INDEXES if get_index_name(index) not in index_names]
+
+
+def get_build_progress(client, namespace):
+    for op in client.admin.aggregate([
+            {"$currentOp": {"allUsers": True}},
+            {"$match": {"ns": namespace, "progress": {"$exists": True}}}]):
+        progress = op["progress"]
+        return f"{op.get('msg', 'building')} ({progress.get('done', 0)} / {progress.get('total', 0)})"
+    return None
+
+
+def watch_build_progress(client, namespace, stop):
+    while not stop.wait(PROGRESS_INTERVAL):
+        try:
+            progress = get_build_progress(client, namespace)
+        except Exception:
+            return
+        if progress is not None:
+            print_flush(f"\r\x1b[1K\rBuilding indexes: {progress}", end="")
+
+
+def build_indexes(client, collection, indexes):
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch_build_progress, args=(client, collection.full_name, stop), daemon=True)
+    watcher.start()
+    try:
+        return collection.create_indexes(indexes)
+    finally:
+        stop.set()
+        watcher.join()
+
+
+def get_plan_stages(explain):
+    stages = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "stage" and isinstance(value, str):
+                stages.append(value)
+            elif key != "rejectedPlans":
+                stages.extend(get_plan_stages(value))
+    elif isinstance(explain, list):
+        for value in explain:
+            stages.extend(get_plan_stages(value))
+    return stages
+
+
+def explain_pipeline(database, collection_name, pipeline):
+    explain = database.command("explain", {"aggregate": collection_name, "pipeline": pipeline, "cursor": {}},
+                               verbosity="queryPlanner")
+    stages = get_plan_stages(explain)
+    if "COLLSCAN" in stages or not any(stage.endswith("IXSCAN") for stage in stages):
+        return "collection scan"
+    if "FETCH" in stages:
+        return "index scan"
+    return "covered"
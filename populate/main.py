@@ -1,16 +1,173 @@
+import argparse
+import os
+import sys
+
+from pymongo.errors import PyMongoError
+
+from export import EXPORT_FORMATS, EXPORT_PARTITIONS, EXPORT_COMPRESSIONS
+from metrics import clear_metrics, serve_metrics
 from populate import Populate
-from user import print_flush, use_env_files, ask_variants, ask_confirm
+from profiling import finish_profiler
+from queries import QUERIES
+from reader import PARSERS, READERS
+from user import print_flush, use_env_files, ask_variants, ask_confirm, panic, \
+    PANIC_DB_ERROR_OCCURRED, PANIC_INVALID_STATE, PANIC_DATAFILE_INVALID
+
+ENV_FLAGS = {
+    "workers": "POPULATE_WORKERS",
+    "parts": "POPULATE_FILE_PARTS",
+    "writers": "POPULATE_WRITERS",
+    "batch_size": "POPULATE_BATCH_SIZE",
+    "parser": "POPULATE_PARSER",
+    "reader": "POPULATE_READER",
+    "format": "EXPORT_FORMAT",
+    "partition": "EXPORT_PARTITION",
+    "export_parts": "EXPORT_PARTS",
+    "compression": "EXPORT_COMPRESSION",
+    "encoding": "EXPORT_ENCODING",
+}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command is None:
+        return interactive()
+    if args.command == "bench":
+        import bench
+        return bench.main(args.bench_args)
+    for name, var in ENV_FLAGS.items():
+        if getattr(args, name, None) is not None:
+            os.environ[var] = str(getattr(args, name))
+    use_env_files()
+    serve_metrics()
+
+    populate = Populate()
+    try:
+        with populate:
+            COMMANDS[args.command](populate, args)
+    except PyMongoError as e:
+        panic(f"Database error: {e}", PANIC_DB_ERROR_OCCURRED)
+    except UnicodeError as e:
+        panic(f"Datafile error: {e}", PANIC_DATAFILE_INVALID)
+    finally:
+        finish_profiler()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Populate MongoDB with ZNO datafiles. "
+                                                 "Runs the interactive menu when no command is given.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("status", help="print the db state")
+    populate = commands.add_parser("populate", help="start, resume or update population, then build indexes")
+    populate.add_argument("--workers", type=int, help="parallel file part workers (POPULATE_WORKERS)")
+    populate.add_argument("--parts", type=int, help="parts to split each file into (POPULATE_FILE_PARTS)")
+    populate.add_argument("--writers", type=int, help="writer threads per part (POPULATE_WRITERS)")
+    populate.add_argument("--batch-size", type=int, help="rows per insert batch (POPULATE_BATCH_SIZE)")
+    populate.add_argument("--parser", choices=list(PARSERS), help="parser backend (POPULATE_PARSER)")
+    populate.add_argument("--reader", choices=list(READERS), help="block reader (POPULATE_READER)")
+    drop = commands.add_parser("drop", help="drop all populated collections")
+    drop.add_argument("--yes", action="store_true", required=True, help="confirm dropping")
+    query = commands.add_parser("query", help="execute a catalogue query into QUERY_FOLDER")
+    query.add_argument("name", choices=list(QUERIES))
+    commands.add_parser("index", help="build missing indexes")
+    commands.add_parser("summary", help="rebuild the query summary collection")
+    export = commands.add_parser("export", help="export the target collection into EXPORT_FOLDER, resuming "
+                                                "an interrupted export")
+    export.add_argument("--format", choices=EXPORT_FORMATS,
+                        help="csv, jsonl or zno (';' separated, quoted, like the datafiles) (EXPORT_FORMAT)")
+    export.add_argument("--partition", choices=EXPORT_PARTITIONS, help="one file per year or per _id range "
+                                                                       "(EXPORT_PARTITION)")
+    export.add_argument("--parts", dest="export_parts", type=int, help="number of _id ranges (EXPORT_PARTS)")
+    export.add_argument("--compression", choices=EXPORT_COMPRESSIONS, help="output compression (EXPORT_COMPRESSION)")
+    export.add_argument("--encoding", help="output encoding of the zno format (EXPORT_ENCODING)")
+    export.add_argument("--workers", type=int, help="parallel part workers (POPULATE_WORKERS)")
+    export.add_argument("--year", dest="years", type=int, action="append", help="export only this year")
+    export.add_argument("--region", dest="regions", action="append", help="export only this REGNAME")
+    export.add_argument("--restart", action="store_true", help="discard an interrupted export")
+    commands.add_parser("bench", add_help=False, help="run the ingestion benchmark (arguments are passed to bench.py)")
+    args, extra = parser.parse_known_args(argv)
+    if args.command != "bench" and extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    args.bench_args = extra[1:] if extra[:1] == ["--"] else extra
+    return args
+
+
+def command_status(populate, _args):
+    state = populate.get_state()
+    print_flush(state)
+    if state == "outdated":
+        for file, year, kind in populate.get_changes():
+            if kind != "touched":
+                print_flush(f"{kind}\t{year}\t{file}")
+
+
+def command_populate(populate, _args):
+    state = populate.get_state()
+    if state == "clear":
+        start(populate)
+    elif state == "interrupted":
+        resume(populate)
+    elif state == "outdated":
+        update(populate)
+    elif state == "unindexed":
+        build_indexes(populate)
+    else:
+        print_flush("Db is already populated")
+
+
+def command_drop(populate, _args):
+    drop_interrupted(populate)
+
+
+def command_query(populate, args):
+    require_state(populate, ["finished", "unindexed", "outdated"])
+    populate.do_query(args.name)
+
+
+def command_index(populate, _args):
+    require_state(populate, ["finished", "unindexed", "outdated"])
+    build_indexes(populate)
+
+
+def command_summary(populate, _args):
+    require_state(populate, ["finished", "unindexed", "outdated"])
+    rebuild_summary(populate)
 
 
-def main():
+def command_export(populate, args):
+    require_state(populate, ["finished", "unindexed", "outdated"])
+    clear_metrics()
+    populate.export(args.years, args.regions, args.restart)
+
+
+def require_state(populate, states):
+    state = populate.get_state()
+    if state not in states:
+        panic(f"Db state is '{state}', expected one of: {', '.join(states)}!", PANIC_INVALID_STATE)
+
+
+COMMANDS = {
+    "status": command_status,
+    "populate": command_populate,
+    "drop": command_drop,
+    "query": command_query,
+    "index": command_index,
+    "summary": command_summary,
+    "export": command_export,
+}
+
+
+def interactive():
     print_flush("\n\n\n")
     print_flush("Populate script started\n")
     use_env_files()
+    serve_metrics()
 
     populate = Populate()
     with populate:
         while handle_state(populate):
             print_flush()
+    finish_profiler()
 
     print_flush("\nPopulate script stopped")
 
@@ -25,9 +182,9 @@ def handle_state(populate):
                 "e": "exit",
             })
             if sel == "r":
-                return reload(populate)
+                return reload(populate, refresh=True)
             elif sel == "s":
-                reload(populate)
+                reload(populate, refresh=True)
                 if populate.get_state() != state:
                     return True
                 return start(populate)
@@ -39,22 +196,100 @@ def handle_state(populate):
             sel = ask_variants("Looks like db is populated.\n", {
                 "r": "reload state",
                 "q": "execute test query",
+                "s": "rebuild query summary",
                 "d": "drop db",
                 "e": "exit",
             })
             if sel == "r":
-                return reload(populate)
+                return reload(populate, refresh=True)
             elif sel == "q":
                 reload(populate)
                 if populate.get_state() != state:
                     return True
-                populate.do_query()
+                execute_query(populate)
+            elif sel == "s":
+                reload(populate, refresh=True)
+                if populate.get_state() != state:
+                    return True
+                rebuild_summary(populate)
             elif sel == "d":
+                reload(populate, refresh=True)
+                if populate.get_state() != state:
+                    return True
+                if ask_confirm():
+                    reload(populate, refresh=True)
+                    if populate.get_state() != state:
+                        return True
+                    return drop_finished(populate)
+            elif sel == "e":
+                return False
+            print_flush()
+    elif state == "outdated":
+        while True:
+            sel = ask_variants("Looks like db is populated, but datafiles were added or changed.\n", {
+                "r": "reload state",
+                "u": "update changed datafiles",
+                "q": "execute test query",
+                "d": "drop db",
+                "e": "exit",
+            })
+            if sel == "r":
+                return reload(populate, refresh=True)
+            elif sel == "u":
+                reload(populate, refresh=True)
+                if populate.get_state() != state:
+                    return True
+                return update(populate)
+            elif sel == "q":
                 reload(populate)
+                if populate.get_state() != state:
+                    return True
+                execute_query(populate)
+            elif sel == "d":
+                reload(populate, refresh=True)
                 if populate.get_state() != state:
                     return True
                 if ask_confirm():
-                    reload(populate)
+                    reload(populate, refresh=True)
+                    if populate.get_state() != state:
+                        return True
+                    return drop_finished(populate)
+            elif sel == "e":
+                return False
+            print_flush()
+    elif state == "unindexed":
+        while True:
+            sel = ask_variants("Looks like db is populated, but indexes are not built.\n", {
+                "r": "reload state",
+                "i": "build indexes",
+                "q": "execute test query",
+                "s": "rebuild query summary",
+                "d": "drop db",
+                "e": "exit",
+            })
+            if sel == "r":
+                return reload(populate, refresh=True)
+            elif sel == "i":
+                reload(populate, refresh=True)
+                if populate.get_state() != state:
+                    return True
+                return build_indexes(populate)
+            elif sel == "q":
+                reload(populate)
+                if populate.get_state() != state:
+                    return True
+                execute_query(populate)
+            elif sel == "s":
+                reload(populate, refresh=True)
+                if populate.get_state() != state:
+                    return True
+                rebuild_summary(populate)
+            elif sel == "d":
+                reload(populate, refresh=True)
+                if populate.get_state() != state:
+                    return True
+                if ask_confirm():
+                    reload(populate, refresh=True)
                     if populate.get_state() != state:
                         return True
                     return drop_finished(populate)
@@ -71,30 +306,27 @@ def handle_state(populate):
                 "e": "exit"
             })
             if sel == "r":
-                reload(populate)
-                if populate.get_state() != state:
-                    return True
-                return reload(populate)
+                return reload(populate, refresh=True)
             elif sel == "c":
-                reload(populate)
+                reload(populate, refresh=True)
                 if populate.get_state() != state:
                     return True
                 return resume(populate)
             elif sel == "f":
-                reload(populate)
+                reload(populate, refresh=True)
                 if populate.get_state() != state:
                     return True
                 if ask_confirm():
-                    reload(populate)
+                    reload(populate, refresh=True)
                     if populate.get_state() != state:
                         return True
                     return assume_finished(populate)
             elif sel == "d":
-                reload(populate)
+                reload(populate, refresh=True)
                 if populate.get_state() != state:
                     return True
                 if ask_confirm():
-                    reload(populate)
+                    reload(populate, refresh=True)
                     if populate.get_state() != state:
                         return True
                     return drop_interrupted(populate)
@@ -104,24 +336,53 @@ def handle_state(populate):
     return False
 
 
-def reload(populate):
+def reload(populate, refresh=False):
     populate.fs.disconnect()
     populate.fs.connect()
+    if refresh:
+        populate.invalidate_state()
     return True
 
 
 def start(populate):
+    clear_metrics()
     populate.prepare()
     populate.start()
     return False
 
 
 def resume(populate):
+    clear_metrics()
     populate.start()
     return False
 
 
+def update(populate):
+    clear_metrics()
+    populate.update()
+    return True
+
+
+def execute_query(populate):
+    names = list(QUERIES)
+    sel = ask_variants("Available queries.\n", {
+        str(i): f"{name} - {QUERIES[name]['description']}" for i, name in enumerate(names, 1)})
+    populate.do_query(names[int(sel) - 1])
+    return True
+
+
+def rebuild_summary(populate):
+    populate.rebuild_summary()
+    return True
+
+
+def build_indexes(populate):
+    populate.build_indexes()
+    return True
+
+
 def assume_finished(populate):
+    populate.finish_manifest()
     clear_artifacts(populate)
     return True
 
@@ -129,6 +390,9 @@ def assume_finished(populate):
 def drop_finished(populate):
     print_flush("Dropping...")
     populate.drop_target()
+    populate.drop_summary()
+    populate.drop_manifest()
+    populate.drop_export()
     return True
 
 
@@ -145,4 +409,4 @@ def drop_interrupted(populate):
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import os
+import sys
+import threading
+
+from reader import READ_AHEAD
+from user import panic, PANIC_ENV_VAR_INVALID
+
+BASE_MEMORY = 96 << 20
+MIN_BLOCK_SIZE = 64 << 10
+MIN_BATCH_MEMORY = 1 << 20
+BLOCK_FACTOR = READ_AHEAD + 8
+WRITER_FACTOR = 5
+
+
+def get_children(pid):
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children", "r") as f:
+            children.extend(int(child) for child in f.read().split())
+    return children
+
+
+def get_rss(pid="self", children=False):
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        if children:
+            rss += sum(get_rss(child, True) for child in get_children(pid))
+        return rss
+    except (OSError, ValueError):
+        if pid != "self":
+            return 0
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_row_memory(values):
+    return sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values if value is not None)
+
+
+def get_min_budget():
+    return BASE_MEMORY + MIN_BLOCK_SIZE * BLOCK_FACTOR + MIN_BATCH_MEMORY * (2 + WRITER_FACTOR)
+
+
+def plan_memory(budget, writers, block_size, queue_size):
+    if not budget:
+        return block_size, queue_size, None
+    if budget < get_min_budget():
+        panic(f"POPULATE_MEMORY_BUDGET is too small, need at least {get_min_budget() >> 20} MB per process!",
+              PANIC_ENV_VAR_INVALID)
+    available = budget - BASE_MEMORY
+    block_size = max(MIN_BLOCK_SIZE, min(block_size, available // 4 // BLOCK_FACTOR))
+    available -= block_size * BLOCK_FACTOR
+    writer_batches = WRITER_FACTOR * max(1, writers)
+    queue_size = max(1, min(queue_size, available // MIN_BATCH_MEMORY - writer_batches - 1))
+    return block_size, queue_size, available // (queue_size + writer_batches + 1)
+
+
+class RssSampler:
+    def __init__(self, interval=0.05, children=True):
+        self.interval = interval
+        self.children = children
+        self.peak = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.peak = get_rss(children=self.children)
+        self.thread.start()
+        return self
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        self.stop.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, get_rss(children=self.children))
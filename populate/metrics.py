@@ -0,0 +1,268 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from inspect import signature
+
+from user import get_env, get_env_int, get_env_size, print_err
+
+SAMPLES = 1024
+QUANTILES = (0.5, 0.9, 0.99)
+METRICS_LOG = "populate_metrics.log"
+METRICS_PROM = "populate_metrics"
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Stage:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=SAMPLES)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    def snapshot(self):
+        samples = list(self.samples)
+        return dict(count=self.count, seconds=round(self.total, 4),
+                    **{f"p{int(q * 100)}_ms": None if not samples else round(percentile(samples, q) * 1000, 2)
+                       for q in QUANTILES})
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, task=None, total_bytes=None):
+        with self.lock:
+            self.task = task
+            self.total_bytes = total_bytes
+            self.started = time.perf_counter()
+            self.rows = 0
+            self.bytes = 0
+            self.stages = dict()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage()
+            stage.observe(seconds)
+
+    def total(self, name):
+        with self.lock:
+            stage = self.stages.get(name)
+            return 0.0 if stage is None else stage.total
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def add(self, rows=0, done_bytes=0):
+        with self.lock:
+            self.rows += rows
+            self.bytes += done_bytes
+
+    def progress(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            rows_per_s = self.rows / elapsed if elapsed else 0.0
+            eta = None
+            if self.total_bytes is not None and self.bytes:
+                eta = (self.total_bytes - self.bytes) * elapsed / self.bytes
+            return rows_per_s, eta
+
+    def snapshot(self):
+        rows_per_s, eta = self.progress()
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            return dict(task=self.task, pid=os.getpid(), elapsed=round(elapsed, 2), rows=self.rows, bytes=self.bytes,
+                        total_bytes=self.total_bytes, rows_per_s=round(rows_per_s, 1),
+                        mb_per_s=round(self.bytes / elapsed / (1 << 20), 2) if elapsed else None,
+                        eta_s=None if eta is None else round(eta, 1),
+                        stages={name: stage.snapshot() for name, stage in self.stages.items()})
+
+
+METRICS = Metrics()
+
+
+def timed(func):
+    parameter = signature(func).parameters["operation_name"]
+    position = list(signature(func).parameters).index("operation_name")
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        operation_name = kwargs.get("operation_name")
+        if operation_name is None:
+            operation_name = args[position] if len(args) > position else parameter.default
+        with METRICS.timer(operation_name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def timed_iter(iterable, name, exclude=None):
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        excluded = 0.0 if exclude is None else METRICS.total(exclude)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        elapsed = time.perf_counter() - started
+        if exclude is not None:
+            elapsed -= METRICS.total(exclude) - excluded
+        METRICS.observe(name, max(0.0, elapsed))
+        yield item
+
+
+def format_prometheus(snapshot):
+    labels = f'task="{snapshot["task"]}",pid="{snapshot["pid"]}"'
+    lines = [
+        f"populate_rows_total{{{labels}}} {snapshot['rows']}",
+        f"populate_bytes_total{{{labels}}} {snapshot['bytes']}",
+        f"populate_elapsed_seconds{{{labels}}} {snapshot['elapsed']}",
+    ]
+    if snapshot["eta_s"] is not None:
+        lines.append(f"populate_eta_seconds{{{labels}}} {snapshot['eta_s']}")
+    for name, stage in snapshot["stages"].items():
+        stage_labels = f'{labels},stage="{name}"'
+        lines.append(f"populate_stage_seconds_total{{{stage_labels}}} {stage['seconds']}")
+        lines.append(f"populate_stage_count{{{stage_labels}}} {stage['count']}")
+        for q in QUANTILES:
+            value = stage[f"p{int(q * 100)}_ms"]
+            if value is not None:
+                lines.append(f'populate_stage_latency_seconds{{{stage_labels},quantile="{q}"}} {value / 1000}')
+    return "\n".join(lines) + "\n"
+
+
+class JsonSink:
+    def __init__(self, folder):
+        self.path = os.path.join(folder, METRICS_LOG)
+        self.max_size = get_env_size("METRICS_LOG_MAX_SIZE", 16 << 20)
+
+    def write(self, snapshot):
+        if self.max_size and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_size:
+            os.replace(self.path, f"{self.path}.1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(dict(snapshot, time=time.strftime("%Y-%m-%dT%H:%M:%S")), ensure_ascii=False) + "\n")
+
+
+class PrometheusSink:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def write(self, snapshot):
+        task = re.sub(r"[^\w.-]", "_", str(snapshot["task"] or os.getpid()))
+        path = os.path.join(self.folder, f"{METRICS_PROM}.{task}.prom")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(format_prometheus(snapshot))
+        os.replace(f"{path}.tmp", path)
+
+
+SINKS = {"json": JsonSink, "prometheus": PrometheusSink}
+
+
+def get_metrics_folder():
+    return get_env("QUERY_FOLDER", required=False) or "."
+
+
+def clear_metrics():
+    folder = get_metrics_folder()
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        if name.startswith(METRICS_PROM) and name.endswith(".prom"):
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError as e:
+                print_err(f"Cannot remove metrics file: {e}")
+
+
+def get_sinks():
+    folder = get_metrics_folder()
+    names = get_env("METRICS_SINKS", required=False) or ""
+    sinks = []
+    for name in [name.strip() for name in names.split(",") if name.strip()]:
+        if name not in SINKS:
+            print_err(f"Unknown metrics sink '{name}', expected one of: {', '.join(SINKS)}")
+            continue
+        sinks.append(SINKS[name](folder))
+    return sinks
+
+
+class MetricsReporter:
+    def __init__(self, sinks=None, interval=None):
+        self.sinks = get_sinks() if sinks is None else sinks
+        self.interval = get_env_int("METRICS_INTERVAL", 10) if interval is None else interval
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        if self.sinks:
+            self.thread.start()
+        return self
+
+    def __exit__(self, _exc_type, _exc_val, _exc_tb):
+        if self.sinks:
+            self.stop.set()
+            self.thread.join()
+            self.report()
+
+    def report(self):
+        snapshot = METRICS.snapshot()
+        for sink in self.sinks:
+            try:
+                sink.write(snapshot)
+            except OSError as e:
+                print_err(f"Cannot write metrics: {e}")
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self.report()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        folder = self.server.folder
+        body = "".join(open(os.path.join(folder, name), encoding="utf-8").read()
+                       for name in sorted(os.listdir(folder))
+                       if name.startswith(METRICS_PROM) and name.endswith(".prom"))
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics():
+    port = get_env_int("METRICS_PORT", 0)
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    server.folder = get_metrics_folder()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,75 @@
+import queue
+import threading
+
+
+class WriterPipeline:
+    def __init__(self, write, commit=None, writers=1, queue_size=4, on_exit=None):
+        self.write = write
+        self.commit = commit
+        self.on_exit = on_exit
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.lock = threading.Lock()
+        self.error = None
+        self.submitted = 0
+        self.next_commit = 0
+        self.completed = dict()
+        self.threads = [threading.Thread(target=self._run, name=f"writer-{i}", daemon=True)
+                        for i in range(max(0, writers))]
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, _exc_tb):
+        if exc_val is not None and self.error is None:
+            self.error = exc_val
+        self.close()
+
+    def submit(self, rows, file_seek):
+        self._check()
+        if self.threads:
+            self.queue.put((self.submitted, rows, file_seek))
+        else:
+            self.write(rows, file_seek)
+            self._complete(self.submitted, file_seek)
+        self.submitted += 1
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if self.error is not None:
+                    continue
+                seq, rows, file_seek = item
+                try:
+                    self.write(rows, file_seek)
+                    self._complete(seq, file_seek)
+                except BaseException as e:
+                    self.error = e
+        finally:
+            if self.on_exit is not None:
+                self.on_exit()
+
+    def _complete(self, seq, file_seek):
+        with self.lock:
+            self.completed[seq] = file_seek
+            while self.next_commit in self.completed:
+                file_seek = self.completed.pop(self.next_commit)
+                self.next_commit += 1
+                if self.commit is not None:
+                    self.commit(file_seek)
@@ -1,9 +1,44 @@
+import codecs
+import bson
 import pymongo
 import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from itertools import islice
 from fs import Fs
+from cache import build_caches, get_cache_file, read_cache
 from db import Db, DbOperation, db_session
-from datafiles import get_file_encoding, get_file_size, format_file_size, strip, strip_arr, read_file
-from user import get_env, print_flush, is_panic
+from datafiles import get_file_encoding, get_file_size, format_file_size, strip_arr, scan_datafiles, \
+    write_encodings_manifest, get_file_stamp, get_file_fingerprint, get_datafile_name, get_data_size, \
+    is_compressed, open_datafile
+from export import export_filter, columns_pipeline, order_columns, years_pipeline, id_sample_pipeline, get_id_bounds, \
+    partition_filter, get_export_path, ExportWriter, EXPORT_FORMATS, EXPORT_PARTITIONS, EXPORT_COMPRESSIONS
+from metrics import METRICS, MetricsReporter, timed_iter
+from profiling import get_profiler, finish_profiler
+from indexes import get_missing_indexes, get_index_name, explain_pipeline
+from memory import get_min_budget, get_row_memory, plan_memory
+from pipeline import WriterPipeline
+from queries import write_query_result, QUERIES, DEFAULT_QUERY
+from schema import build_schema, make_values, RowBatch
+from sharding import parse_shard_key, get_split_points, split_by_shard_key
+from summary import summary_requests, summary_rebuild_pipeline
+from reader import read_header, split_ranges, PARSERS, READERS, BLOCK_SIZE
+from user import get_env, get_env_int, get_env_bool, get_env_choice, get_env_size, print_flush, is_panic, \
+    use_env_files, run_workers, panic, PANIC_ENV_VAR_INVALID, PANIC_INVALID_STATE
+
+
+def changes_state(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.invalidate_state()
+
+    return wrapper
 
 
 class Populate:
@@ -13,27 +48,50 @@ class Populate:
                     port=get_env("MONGO_PORT", required=False),
                     db_name=get_env("MONGO_DBNAME"),
                     username=get_env("MONGO_INITDB_ROOT_USERNAME", required=False),
-                    password=get_env("MONGO_INITDB_ROOT_PASSWORD", required=False))
+                    password=get_env("MONGO_INITDB_ROOT_PASSWORD", required=False),
+                    write_concern=get_env("MONGO_WRITE_CONCERN", required=False),
+                    pool_size=get_env("MONGO_POOL_SIZE", required=False),
+                    journal=get_env("MONGO_JOURNAL", required=False))
         self.target_collection_name = get_env("TARGET_COLLECTION_NAME")
         self.target_collection = None
         self.aux_collection_name = get_env("AUX_COLLECTION_NAME")
         self.aux_collection = None
+        self.summary_collection_name = get_env("SUMMARY_COLLECTION_NAME")
+        self.manifest_collection_name = get_env("MANIFEST_COLLECTION_NAME")
+        self.export_collection_name = get_env("EXPORT_COLLECTION_NAME", required=False) or \
+            f"{self.target_collection_name}_export"
+        self.batch_size = get_env_int("POPULATE_BATCH_SIZE", 1000)
+        self.batch_bytes = get_env_int("POPULATE_BATCH_BYTES", 8 << 20)
+        self.memory_budget = get_env_size("POPULATE_MEMORY_BUDGET", 0)
+        self.ordered_inserts = get_env_bool("POPULATE_ORDERED_INSERTS", False)
+        self.use_transactions = get_env_bool("POPULATE_TRANSACTIONS", True)
+        self.schema = get_env_choice("POPULATE_SCHEMA", ["typed", "raw"], "typed")
+        self.shard_key = parse_shard_key(get_env("MONGO_SHARD_KEY", required=False))
+        self.presplit = get_env_bool("MONGO_PRESPLIT", True)
+        self.state_ttl = get_env_int("STATE_CACHE_SECONDS", 10)
+        self.state_cache = None
+        self.probe_pool = None
 
         self.fs = Fs()
         self.db = Db(auth)
+        self.cache = get_env_bool("POPULATE_CACHE", False) and self.schema == "typed"
+        self.cache_folder = get_env("POPULATE_CACHE_FOLDER", required=False) or \
+            os.path.join(self.fs.data_folder, ".cache")
 
     def __enter__(self):
         self.fs.connect()
         self.db.connect()
+        self.probe_pool = ThreadPoolExecutor(3, thread_name_prefix="probe")
 
     def __exit__(self, _exc_type, _exc_val, _exc_tb):
         if is_panic():
             return
+        self.probe_pool.shutdown()
         self.db.disconnect()
         self.fs.disconnect()
 
     def get_session(self):
-        return self.db.client.start_session()
+        return self.db.session()
 
     def get_database(self, session):
         return session.client[self.db.auth["db_name"]]
@@ -44,40 +102,133 @@ class Populate:
     def get_aux_collection(self, session, db):
         return DbOperation(session, db).get_collection(self.aux_collection_name, "GET AUX COLLECTION")
 
-    def get_state(self):
-        @db_session
-        def _get_state(session, db):
-            target_collection_exists = DbOperation(session, db).check_collection_exists(
-                self.target_collection_name, "GET TARGET COLLECTION")
-            aux_collection_exists = DbOperation(session, db).check_collection_exists(
-                self.aux_collection_name, "GET AUX COLLECTION")
-
-            if aux_collection_exists:
-                return "interrupted"
-            else:
-                if target_collection_exists:
-                    return "finished"
-                else:
-                    return "clear"
+    def get_summary_collection(self, session, db):
+        return DbOperation(session, db).get_collection(self.summary_collection_name, "GET SUMMARY COLLECTION")
+
+    def get_manifest_collection(self, session, db):
+        return DbOperation(session, db).get_collection(self.manifest_collection_name, "GET MANIFEST COLLECTION")
+
+    def get_export_collection(self, session, db):
+        return DbOperation(session, db).get_collection(self.export_collection_name, "GET EXPORT COLLECTION")
+
+    def has_summary(self):
+        @db_session(transaction=False)
+        def _has_summary(session, db):
+            return self.summary_collection_name in DbOperation(session, db).get_existing_collections(
+                [self.summary_collection_name], "GET SUMMARY COLLECTION")
+
+        return _has_summary(self)
+
+    def invalidate_state(self):
+        self.state_cache = None
+
+    def get_state_key(self):
+        return self.fs.data_folder_mtime, tuple(tuple(get_file_stamp(file).values()) for file, _ in self.fs.data_files)
+
+    def get_state(self, refresh=False):
+        self.fs.connect()
+        key = self.get_state_key()
+        if not refresh and self.state_cache is not None:
+            cached_key, cached_at, state = self.state_cache
+            if cached_key == key and time.monotonic() - cached_at < self.state_ttl:
+                return state
+        state = self.probe_state()
+        self.state_cache = (key, time.monotonic(), state)
+        return state
+
+    def probe_state(self):
+        @db_session(transaction=False)
+        def _get_collections(session, db):
+            return DbOperation(session, db).get_existing_collections(
+                [self.target_collection_name, self.aux_collection_name, self.manifest_collection_name],
+                "GET STATE COLLECTIONS")
 
-        return _get_state(self)
+        @db_session(transaction=False)
+        def _get_index_names(session, db):
+            return DbOperation(session, db).get_index_names(self.get_target_collection(session, db))
 
+        collections = self.probe_pool.submit(_get_collections, self)
+        index_names = self.probe_pool.submit(_get_index_names, self)
+        manifest = self.probe_pool.submit(self.get_manifest)
+        existing_collections = collections.result()
+
+        if self.aux_collection_name in existing_collections:
+            return "interrupted"
+        else:
+            if self.target_collection_name in existing_collections:
+                if self.manifest_collection_name in existing_collections and \
+                        any(kind != "touched" for _, _, kind in self.get_changes(manifest.result())):
+                    return "outdated"
+                if get_missing_indexes(index_names.result()):
+                    return "unindexed"
+                return "finished"
+            else:
+                return "clear"
+
+    @changes_state
     def drop_target(self):
-        @db_session
+        @db_session(transaction=False)
         def _drop_target(session, db):
             DbOperation(session, db).drop_collection(self.get_target_collection(session, db), "DROP TARGET COLLECTION")
 
         return _drop_target(self)
 
+    @changes_state
     def drop_aux(self):
-        @db_session
+        @db_session(transaction=False)
         def _drop_aux(session, db):
             DbOperation(session, db).drop_collection(self.get_aux_collection(session, db), "DROP AUX COLLECTION")
 
         return _drop_aux(self)
 
+    @changes_state
+    def drop_summary(self):
+        @db_session(transaction=False)
+        def _drop_summary(session, db):
+            DbOperation(session, db).drop_collection(self.get_summary_collection(session, db),
+                                                     "DROP SUMMARY COLLECTION")
+
+        return _drop_summary(self)
+
+    @changes_state
+    def drop_manifest(self):
+        @db_session(transaction=False)
+        def _drop_manifest(session, db):
+            DbOperation(session, db).drop_collection(self.get_manifest_collection(session, db),
+                                                     "DROP MANIFEST COLLECTION")
+
+        return _drop_manifest(self)
+
+    def drop_export(self):
+        @db_session(transaction=False)
+        def _drop_export(session, db):
+            DbOperation(session, db).drop_collection(self.get_export_collection(session, db),
+                                                     "DROP EXPORT COLLECTION")
+
+        return _drop_export(self)
+
+    def rebuild_summary(self, years=None):
+        print_flush("Rebuilding summary...", end="")
+
+        @db_session(transaction=False)
+        def _rebuild_summary(session, db):
+            summary_collection = self.get_summary_collection(session, db)
+            if years is None:
+                DbOperation(session, db).drop_collection(summary_collection, "DROP SUMMARY COLLECTION")
+            else:
+                DbOperation(session, db).delete_many_data(summary_collection, {"_id.year": {"$in": list(years)}},
+                                                          "DROP SUMMARY YEARS")
+            target_collection = self.get_target_collection(session, db)
+            DbOperation(session, db).aggregate(
+                target_collection, summary_rebuild_pipeline(self.summary_collection_name, years), "REBUILD SUMMARY")
+            return self.get_summary_collection(session, db).estimated_document_count()
+
+        groups = _rebuild_summary(self)
+        print_flush(f" done! {groups} summary groups written")
+
+    @changes_state
     def start(self):
-        @db_session
+        @db_session(transaction=False)
         def _get_entries(session, db):
             target_collection = self.get_target_collection(session, db)
             dummy = target_collection.find_one({"dummy": 0})
@@ -85,10 +236,16 @@ class Populate:
                 DbOperation(session, db).insert_data(target_collection,
                                                      [{"dummy": 0}], "INSERT TARGET DUMMY", use_session=False)
             aux_collection = self.get_aux_collection(session, db)
-            return aux_collection.find().sort("tr_id", pymongo.DESCENDING)
+            return list(DbOperation(session, db).aggregate(aux_collection, [
+                {"$sort": {"tr_id": pymongo.DESCENDING}},
+                {"$group": {"_id": {"file_name": "$file_name", "part": {"$ifNull": ["$part", 0]}},
+                            "entry": {"$first": "$$ROOT"}}},
+                {"$replaceRoot": {"newRoot": "$entry"}},
+                {"$sort": {"tr_id": pymongo.DESCENDING, "file_name": pymongo.ASCENDING}},
+            ], "GET LATEST AUX ENTRIES"))
 
         entries = _get_entries(self)
-        if entries.count() == 0:
+        if len(entries) == 0:
             @db_session
             def _delete_dummy(session, db):
                 target_collection = self.get_target_collection(session, db)
@@ -96,145 +253,594 @@ class Populate:
                 if dummy is not None:
                     DbOperation(session, db).delete_data(target_collection, dummy, "INSERT TARGET DUMMY")
             _delete_dummy(self)
+            finish_profiler()
+            self.finish_manifest()
             self.drop_aux()
+            self.build_indexes()
             return True
 
-        entry = entries[0]
-        entry_id, file_name, year, file_seek, header_text, tr_id = \
-            entry["_id"], entry["file_name"], entry["year"], entry["file_seek"], entry["header"], entry["tr_id"]
+        latest_entries = {(entry["file_name"], entry.get("part", 0)): entry for entry in entries}
+        unplanned = [entry for entry in latest_entries.values() if not entry.get("planned", entry["file_seek"] != 0)]
+        for entry in unplanned:
+            self.plan_file(entry)
+        if unplanned:
+            return self.start()
+
+        tasks = list(latest_entries)
+        workers = min(get_env_int("POPULATE_WORKERS", 1), len(tasks))
+        if workers > 1:
+            budget = self.get_worker_budget(workers)
+            print_flush(f"Populating {len(tasks)} file parts using {workers} workers")
+            run_workers(populate_part, [(file_name, part, budget) for file_name, part in tasks], workers)
+        else:
+            for file_name, part in tasks:
+                self.populate_part(file_name, part)
+        return self.start()
+
+    def get_worker_budget(self, workers):
+        if not self.memory_budget:
+            return 0
+        budget = self.memory_budget // (workers + 1)
+        if budget < get_min_budget():
+            panic(f"POPULATE_MEMORY_BUDGET is too small for {workers} workers, need at least "
+                  f"{get_min_budget() * (workers + 1) >> 20} MB!", PANIC_ENV_VAR_INVALID)
+        return budget
+
+    def get_manifest(self):
+        @db_session(transaction=False)
+        def _get_manifest(session, db):
+            return {entry["_id"]: entry for entry in self.get_manifest_collection(session, db).find()}
+
+        return _get_manifest(self)
+
+    def get_changes(self, manifest=None):
+        manifest = dict(self.get_manifest() if manifest is None else manifest)
+        changes = []
+        for file, year in self.fs.data_files:
+            entry = manifest.pop(get_datafile_name(file), None)
+            if entry is None:
+                changes.append((file, year, "new"))
+                continue
+            stamp = get_file_stamp(file)
+            if entry["status"] == "done" and entry["size"] == stamp["size"]:
+                if entry["mtime"] == stamp["mtime"]:
+                    continue
+                if entry["hash"] == get_file_fingerprint(file):
+                    changes.append((file, year, "touched"))
+                    continue
+            changes.append((file, year, "changed"))
+        changes.extend((entry["file_name"], entry["year"], "removed") for entry in manifest.values())
+        return changes
+
+    @changes_state
+    def update(self):
+        changes = self.get_changes()
+        for file, year, kind in changes:
+            if kind != "touched":
+                print_flush(f"File '{file}' ({year}): {kind}")
+        files = [(file, year) for file, year, kind in changes if kind in ("new", "changed")]
+        self.detect_file_encodings([file for file, _ in files])
+        if self.cache:
+            build_caches(self.cache_folder, [file for file, _ in files], get_env_int("POPULATE_WORKERS", 1))
+
+        @db_session(transaction=False)
+        def _update(session, db):
+            manifest_collection = self.get_manifest_collection(session, db)
+            target_collection = self.get_target_collection(session, db)
+            for file, year, kind in changes:
+                if kind == "touched":
+                    update = {"$set": get_file_stamp(file)}
+                elif kind == "removed":
+                    update = {"$set": {"status": "removed"}}
+                else:
+                    update = {"$set": dict(self.get_manifest_entry(file, year), replace=kind == "changed")}
+                DbOperation(session, db).update_fields(manifest_collection, {"_id": get_datafile_name(file)}, update,
+                                                       "UPDATE MANIFEST ENTRY", upsert=True)
+            for file, year, kind in changes:
+                if kind in ("changed", "removed"):
+                    print_flush(f"Deleting documents of file '{file}'...", end="")
+                    result = DbOperation(session, db).delete_many_data(
+                        target_collection, get_file_filter(file), "DELETE FILE DOCUMENTS")
+                    print_flush(f" done! {result.deleted_count} documents deleted")
+            if files:
+                DbOperation(session, db).insert_data(self.get_aux_collection(session, db), get_aux_entries(files),
+                                                     "FILL AUX COLLECTION", use_session=False)
+
+        _update(self)
+        return self.start()
+
+    def get_manifest_entry(self, file, year):
+        return dict(get_file_stamp(file), file_name=file, year=year, hash=get_file_fingerprint(file),
+                    rows=None, status="pending")
+
+    def finish_manifest(self):
+        @db_session(transaction=False)
+        def _get_pending(session, db):
+            return list(self.get_manifest_collection(session, db).find({"status": {"$ne": "done"}}))
+
+        pending = _get_pending(self)
+        years = {entry["year"] for entry in pending
+                 if entry["status"] == "removed" or entry.get("replace") or entry.get("summary_stale")}
+        if years and self.has_summary():
+            self.rebuild_summary(years)
+
+        @db_session(transaction=False)
+        def _finish_manifest(session, db):
+            manifest_collection = self.get_manifest_collection(session, db)
+            target_collection = self.get_target_collection(session, db)
+            for entry in pending:
+                if entry["status"] == "removed":
+                    DbOperation(session, db).delete_data(manifest_collection, entry, "DROP MANIFEST ENTRY")
+                    continue
+                rows = DbOperation(session, db).count_data(target_collection, get_file_filter(entry["file_name"]),
+                                                           "COUNT FILE DOCUMENTS")
+                DbOperation(session, db).update_fields(manifest_collection, {"_id": entry["_id"]}, {
+                    "$set": {"status": "done", "rows": rows},
+                    "$unset": {"replace": "", "summary_stale": ""}}, "FINISH MANIFEST ENTRY")
+
+        _finish_manifest(self)
+
+    def plan_file(self, entry):
+        file_name, encoding = entry["file_name"], get_file_encoding(entry["file_name"])
+        with open_datafile(file_name) as file:
+            header_text, file_seek = read_header(file, encoding)
+            header_len = len(header_text.split(';'))
+            parts = 1 if is_compressed(file_name) else get_env_int("POPULATE_FILE_PARTS", 1)
+            ranges = [(file_seek, None)]
+            if parts > 1:
+                ranges = split_ranges(file, header_len, encoding, file_seek, get_file_size(file_name), parts)
+
+        header = [h.upper() for h in strip_arr(header_text.split(';'))]
+
+        @db_session
+        def _plan_file(session, db):
+            aux_collection = self.get_aux_collection(session, db)
+            DbOperation(session, db).update_fields(self.get_manifest_collection(session, db),
+                                                   {"_id": get_datafile_name(file_name)}, {"$set": {"header": header}},
+                                                   "SAVE FILE HEADER")
+            DbOperation(session, db).insert_data(aux_collection, [{
+                "file_name": file_name,
+                "year": entry["year"],
+                "part": part,
+                "file_start": range_start,
+                "file_seek": range_start,
+                "file_end": range_end,
+                "header": header_text,
+                "planned": True,
+                "tr_id": entry["tr_id"] + 1}
+                for part, (range_start, range_end) in enumerate(ranges)], "SPLIT FILE PARTS")
+            DbOperation(session, db).delete_data(aux_collection, entry, "DROP UNPLANNED AUX ENTRY")
+
+        _plan_file(self)
+
+    @changes_state
+    def populate_part(self, file_name, part=0, show_progress=True):
+        part_filter = {"file_name": file_name, "part": part if part else {"$in": [0, None]}}
+
+        @db_session(transaction=False)
+        def _get_entry(session, db):
+            aux_collection = self.get_aux_collection(session, db)
+            return aux_collection.find_one(part_filter, sort=[("tr_id", pymongo.DESCENDING)])
+
+        entry = _get_entry(self)
+        if entry is None:
+            return
+
+        @db_session(transaction=False)
+        def _remove_old_aux(session, db):
+            aux_collection = self.get_aux_collection(session, db)
+            DbOperation(session, db).delete_many_data(
+                aux_collection, dict(part_filter, _id={"$ne": entry["_id"]}), "DROP OLD AUX ENTRIES")
+
+        id_prefix = get_datafile_name(file_name)
+        year, file_seek, header_text = entry["year"], entry["file_seek"], entry["header"]
+        file_end = entry.get("file_end")
+        encoding = get_file_encoding(file_name)
         file_size = get_file_size(file_name)
-        print_flush(f"Populating from file '{file_name}' ({year}): ", end='')
-        with open(file_name, "r", encoding=get_file_encoding(file_name)) as file:
-            if file_seek == 0:
-                entry["header"] = header_text = file.readline().strip()
-                entry["file_seek"] = file.tell()
-
-                @db_session
-                def _set_header_text(session, db):
-                    aux_collection = self.get_aux_collection(session, db)
-                    DbOperation(session, db).update_data(aux_collection, entry, "SAVE AUX HEADER")
-
-                _set_header_text(self)
+        range_start = entry.get("file_start", 0)
+        range_size = (file_size if file_end is None else file_end) - range_start
+        METRICS.reset(f"{id_prefix}:{part}", range_size - (file_seek - range_start))
+        _remove_old_aux(self)
+        title = f"Populating from file '{file_name}' ({year})"
+        if file_end is not None or part:
+            title += f" part {part}"
+        if show_progress:
+            print_flush(f"{title}: ", end='')
+        else:
+            print_flush(f"{title}: started")
+        header = strip_arr(header_text.split(';'))
+        header = tuple(sys.intern(h.upper()) for h in header)
+        parse = PARSERS[get_env_choice("POPULATE_PARSER", list(PARSERS), "block")]
+        read_blocks = READERS["buffered" if is_compressed(file_name) or self.memory_budget else
+                              get_env_choice("POPULATE_READER", list(READERS), "buffered")]
+        writers = get_env_int("POPULATE_WRITERS", 1)
+        profiler = get_profiler()
+        if profiler is not None:
+            profiler.start()
+            if profiler.running and profiler.mode == "cprofile":
+                writers = 0
+        block_size = get_env_int("POPULATE_BLOCK_SIZE", BLOCK_SIZE)
+        queue_size = get_env_int("POPULATE_QUEUE_SIZE", 4)
+        block_size, queue_size, batch_memory = plan_memory(self.memory_budget, writers, block_size, queue_size)
+        use_transactions = self.use_transactions and writers <= 1 and entry.get("transactions", True)
+        use_summary = self.schema == "typed" and self.has_summary()
+        cache_path = get_cache_file(self.cache_folder, file_name) if self.cache else None
+
+        @db_session(transaction=False)
+        def _save_write_mode(session, db):
+            aux_collection = self.get_aux_collection(session, db)
+            DbOperation(session, db).update_fields(aux_collection, {"_id": entry["_id"]}, {
+                "$set": {"transactions": False}}, "SAVE WRITE MODE")
+
+        def update_file_seek(session, db, file_seek):
+            aux_collection = self.get_aux_collection(session, db)
+            DbOperation(session, db).update_fields(aux_collection, {"_id": entry["_id"]}, {
+                "$max": {"file_seek": file_seek},
+                "$inc": {"tr_id": 1}}, "UPDATE FILE SEEK")
+
+        summary_stale = [False]
+
+        @db_session(transaction=use_transactions)
+        def _insert_rows(session, db, rows, file_seek):
+            target_collection = self.get_target_collection(session, db)
+            groups = split_by_shard_key(rows, self.shard_key) if self.shard_key else [rows]
+            if use_transactions:
+                for group in groups:
+                    DbOperation(session, db).insert_data(target_collection, group, "INSERT ROWS",
+                                                         ordered=self.ordered_inserts)
             else:
-                file.seek(file_seek)
-            header = strip_arr(header_text.split(';'))
-            header = [h.upper() for h in header]
-            batch_size = 1000
-            while True:
-                print_flush(f"\rPopulating from file '{file_name}' ({year}): "
-                            f"{format_file_size(entry['file_seek'])} / {format_file_size(file_size)} "
-                            f"({entry['file_seek'] / file_size:.2%})", end="")
-                end = False
-                rows = []
-                for i in range(batch_size):
-                    line = []
-                    prev_line_text = ""
-                    while True:
-                        line_text = prev_line_text + file.readline().strip()
-                        if not line_text:
-                            end = True
-                            break
-                        line = [strip(l) for l in line_text.rstrip().split(';')]
-                        if len(line) == len(header):
-                            break
-                        prev_line_text = line_text
-                    if end:
-                        break
-                    row = {}
-                    for h, v in zip(header, line):
-                        row[h] = v
-                    row["year"] = year
-                    rows.append(row)
-
-                @db_session
-                def _insert_rows(session, db):
-                    aux_collection = self.get_aux_collection(session, db)
-                    target_collection = self.get_target_collection(session, db)
-                    DbOperation(session, db).insert_data(target_collection, rows, "INSERT ROWS")
-
-                    if end:
-                        print_flush(f"\r\x1b[1K\rPopulating from file '{file_name}' ({year}): {' ' * 35}", end="")
-                        print_flush(f"\r\x1b[1K\rPopulating from file '{file_name}' ({year}): done!")
-                        DbOperation(session, db).delete_data(aux_collection, entry, "DROP AUX COLLECTION")
-                    else:
-                        entry["file_seek"] = file.tell()
-                        entry["tr_id"] = entry["tr_id"] + 1
-                        DbOperation(session, db).insert_data(aux_collection, [{
-                            "file_name": file_name,
-                            "year": year,
-                            "file_seek": file.tell(),
-                            "header": header_text,
-                            "tr_id": entry["tr_id"]}], "UPDATE FILE SEEK")
-
-                _insert_rows(self)
-
-                @db_session
-                def _remove_old_aux(session, db):
-                    aux_collection = self.get_aux_collection(session, db)
-                    for old_entry in aux_collection.find(
-                            ({"file_name": file_name} if end else
-                            {"file_name": file_name, "tr_id": {"$ne": entry["tr_id"]}})):
-                        DbOperation(session, db).delete_data(aux_collection, old_entry)
-
-                _remove_old_aux(self)
-                if end:
-                    return self.start()
+                inserted = [row for group in groups for row in
+                            DbOperation(session, db).insert_new_data(target_collection, group, "INSERT ROWS")]
+                if use_summary and len(inserted) < len(rows) and not summary_stale[0]:
+                    manifest_collection = self.get_manifest_collection(session, db)
+                    DbOperation(session, db).update_fields(manifest_collection, {"_id": id_prefix}, {
+                        "$set": {"summary_stale": True}}, "MARK SUMMARY STALE")
+                    summary_stale[0] = True
+                rows = inserted
+            if use_summary and rows:
+                DbOperation(session, db).bulk_write(self.get_summary_collection(session, db),
+                                                    summary_requests(rows), "UPDATE SUMMARY")
+            if use_transactions:
+                update_file_seek(session, db, file_seek)
 
-    def prepare(self):
-        df_changed = False
-        for file, year in self.fs.data_files:
-            if get_file_encoding(file) == "":
-                print_flush(f"Determining encoding of file '{file}': ", end="")
-                read_file(file)
-                print_flush("done!")
-                df_changed = True
-        if df_changed:
-            self.fs.disconnect()
-            self.fs.connect()
+        @db_session(transaction=False)
+        def _update_file_seek(session, db, file_seek):
+            update_file_seek(session, db, file_seek)
+
+        def write_batch(rows, seek):
+            with METRICS.timer("batch"):
+                _insert_rows(self, rows.documents(), seek)
+            METRICS.add(rows=len(rows))
+
+        committed_seek = [file_seek]
+
+        def commit_batch(seek):
+            if not use_transactions:
+                _update_file_seek(self, seek)
+            METRICS.add(done_bytes=seek - committed_seek[0])
+            committed_seek[0] = seek
 
         @db_session
+        def _drop_part_aux(session, db):
+            aux_collection = self.get_aux_collection(session, db)
+            DbOperation(session, db).delete_many_data(aux_collection, part_filter, "DROP AUX ENTRY")
+
+        if not use_transactions and entry.get("transactions", True):
+            _save_write_mode(self)
+        with MetricsReporter():
+            with open_datafile(file_name) as file:
+                if cache_path is None:
+                    blocks = timed_iter(read_blocks(file, file_seek, block_size), "read")
+                    records = parse(blocks, len(header), encoding, file_seek, file_end)
+                else:
+                    records = timed_iter(read_cache(cache_path, file_seek, file_end, self.batch_size), "read")
+                batches = timed_iter(self.read_batches(records, header, year, id_prefix, cache_path is not None,
+                                                       batch_memory), "parse", exclude="read")
+                with WriterPipeline(write_batch, commit_batch, writers, queue_size,
+                                    self.db.release_session) as pipeline:
+                    for rows, file_seek in batches:
+                        if show_progress:
+                            rows_per_s, eta = METRICS.progress()
+                            print_flush(f"\r{title}: "
+                                        f"{format_file_size(file_seek - range_start)} / "
+                                        f"{format_file_size(range_size)} "
+                                        f"({(file_seek - range_start) / max(range_size, 1):.2%}, "
+                                        f"{rows_per_s:.0f} rows/s"
+                                        f"{'' if eta is None else f', ETA {eta:.0f}s'})", end="")
+                        pipeline.submit(rows, file_seek)
+                        if profiler is not None:
+                            profiler.tick()
+            _drop_part_aux(self)
+        if show_progress:
+            print_flush(f"\r\x1b[1K\r{title}: {' ' * 60}", end="")
+            print_flush(f"\r\x1b[1K\r{title}: done!")
+        else:
+            print_flush(f"{title}: done!")
+
+    def get_batch_size(self, rows, batch_memory=None):
+        sample = rows.rows[0]
+        batch_size = max(1, min(self.batch_size, self.batch_bytes // len(bson.encode(rows.document(sample)))))
+        if batch_memory is not None:
+            batch_size = max(1, min(batch_size, batch_memory // get_row_memory(sample)))
+        return batch_size
+
+    def read_batches(self, records, header, year, id_prefix, cached=False, batch_memory=None):
+        batch_size = None
+        schema = build_schema(header) if self.schema == "typed" and not cached else None
+        rows = RowBatch(header)
+        offset = None
+        for lines, offsets in records:
+            for line, offset in zip(lines, offsets):
+                rows.append(line if schema is None else make_values(line, schema), f"{id_prefix}:{offset}", year)
+                if batch_size is None:
+                    batch_size = self.get_batch_size(rows, batch_memory)
+                if len(rows) >= batch_size:
+                    yield rows, offset
+                    batch_size = self.get_batch_size(rows, batch_memory)
+                    rows = RowBatch(header)
+        if rows:
+            yield rows, offset
+
+    @changes_state
+    def build_indexes(self):
+        @db_session(transaction=False)
+        def _build_indexes(session, db):
+            target_collection = self.get_target_collection(session, db)
+            missing = get_missing_indexes(DbOperation(session, db).get_index_names(target_collection))
+            if missing:
+                print_flush(f"Building indexes: {', '.join(get_index_name(index) for index in missing)}", end="")
+                DbOperation(session, db).create_indexes(target_collection, missing, "CREATE TARGET INDEXES")
+                print_flush("\r\x1b[1K\rBuilding indexes: done!")
+            for name, pipeline in self.get_queries().items():
+                plan = explain_pipeline(db, self.target_collection_name, pipeline)
+                print_flush(f"Query '{name}' plan: {plan}")
+
+        return _build_indexes(self)
+
+    def get_queries(self):
+        return {name: query["pipeline"]() for name, query in QUERIES.items()}
+
+    def detect_file_encodings(self, files):
+        unknown = [file for file in files if get_file_encoding(file) == "" or get_data_size(file) is None]
+        if unknown:
+            print_flush(f"Scanning {len(unknown)} file(s): ", end="")
+            scans = scan_datafiles(unknown, get_env_int("POPULATE_WORKERS", 1))
+            write_encodings_manifest(self.fs.data_folder, scans)
+            print_flush("done!")
+            for file, scan in scans.items():
+                size = "" if scan["data_size"] is None else f", {format_file_size(scan['data_size'])} decompressed"
+                print_flush(f"\t'{file}': {scan['encoding']}{size}")
+
+    @changes_state
+    def prepare(self):
+        self.detect_file_encodings([file for file, year in self.fs.data_files])
+        if self.cache:
+            build_caches(self.cache_folder, [file for file, year in self.fs.data_files],
+                         get_env_int("POPULATE_WORKERS", 1))
+
+        @db_session(transaction=False)
         def _prepare(session, db):
             aux_collection = self.get_aux_collection(session, db)
             if len(self.fs.data_files) == 0:
                 return
+            manifest_collection = self.get_manifest_collection(session, db)
+            DbOperation(session, db).drop_collection(manifest_collection, "DROP MANIFEST COLLECTION")
+            DbOperation(session, db).insert_data(
+                manifest_collection,
+                [dict(self.get_manifest_entry(file, year), _id=get_datafile_name(file))
+                 for file, year in self.fs.data_files],
+                "FILL MANIFEST COLLECTION", use_session=False)
+            DbOperation(session, db).drop_collection(self.get_summary_collection(session, db),
+                                                     "DROP SUMMARY COLLECTION")
+            if self.schema == "typed":
+                DbOperation(session, db).create_collection(self.summary_collection_name,
+                                                           "CREATE SUMMARY COLLECTION")
+            if self.shard_key:
+                split_points = []
+                if self.presplit:
+                    split_points = get_split_points(self.shard_key, [year for _, year in self.fs.data_files],
+                                                    self.schema == "typed")
+                DbOperation(session, db).shard_collection(self.get_target_collection(session, db), self.shard_key,
+                                                          split_points, "SHARD TARGET COLLECTION")
             DbOperation(session, db).insert_data(
-                aux_collection,
-                [{
-                    "file_name": file,
-                    "year": year,
-                    "file_seek": 0,
-                    "header": "",
-                    "tr_id": 0}
-                    for file, year in self.fs.data_files],
-                "FILL AUX COLLECTION", use_session=False)
+                aux_collection, get_aux_entries(self.fs.data_files), "FILL AUX COLLECTION", use_session=False)
             return False
 
         return _prepare(self)
 
-    def do_query(self):
-        print_flush("Executing query...", end="")
-        @db_session
+    def do_query(self, name=DEFAULT_QUERY):
+        query = QUERIES[name]
+        path = os.path.join(self.fs.query_folder, query["file_name"])
+        use_summary = self.has_summary()
+        print_flush(f"Executing query '{name}'{' from summary' if use_summary else ''}...", end="")
+
+        @db_session(transaction=False)
         def _do_query(session, db):
+            if use_summary:
+                collection, pipeline = self.get_summary_collection(session, db), query["summary_pipeline"]()
+            else:
+                collection, pipeline = self.get_target_collection(session, db), query["pipeline"]()
+            return write_query_result(collection, pipeline, query, path, get_env_int("QUERY_BATCH_SIZE", 1000))
+
+        rows = _do_query(self)
+        print_flush(f" done! {rows} rows written to '{path}'")
+
+    def get_export_spec(self, years=None, regions=None):
+        spec = dict(format=get_env_choice("EXPORT_FORMAT", EXPORT_FORMATS, "csv"),
+                    partition=get_env_choice("EXPORT_PARTITION", EXPORT_PARTITIONS, "year"),
+                    parts=get_env_int("EXPORT_PARTS", 1),
+                    compression=get_env_choice("EXPORT_COMPRESSION", EXPORT_COMPRESSIONS, "gzip"),
+                    encoding=get_env("EXPORT_ENCODING", required=False) or "utf-8",
+                    folder=get_env("EXPORT_FOLDER", required=False) or os.path.join(self.fs.query_folder, "export"),
+                    years=sorted(years) if years else None,
+                    regions=sorted(regions) if regions else None)
+        try:
+            codecs.lookup(spec["encoding"])
+        except LookupError:
+            panic(f"Environment variable 'EXPORT_ENCODING' must be a known encoding, got '{spec['encoding']}'!",
+                  PANIC_ENV_VAR_INVALID)
+        return spec
+
+    def get_export_parts(self):
+        @db_session(transaction=False)
+        def _get_export_parts(session, db):
+            return list(self.get_export_collection(session, db).find(sort=[("part", pymongo.ASCENDING)]))
+
+        return _get_export_parts(self)
+
+    def export(self, years=None, regions=None, restart=False):
+        spec = self.get_export_spec(years, regions)
+        if restart:
+            self.drop_export()
+        parts = self.get_export_parts()
+        if parts and {k: v for k, v in parts[0]["spec"].items() if k != "columns"} != spec:
+            panic("An interrupted export with different settings exists, "
+                  "rerun it with the same settings or restart it!", PANIC_INVALID_STATE)
+        if not parts:
+            self.plan_export(spec)
+            parts = self.get_export_parts()
+        if not parts:
+            print_flush("Nothing to export")
+            return 0
+        pending = [part["_id"] for part in parts if part["status"] != "done"]
+        if len(pending) < len(parts):
+            print_flush(f"Resuming export: {len(parts) - len(pending)} of {len(parts)} parts already done")
+        workers = min(get_env_int("POPULATE_WORKERS", 1), len(pending))
+        if workers > 1:
+            print_flush(f"Exporting {len(pending)} parts using {workers} workers")
+            run_workers(export_part, [(part_id,) for part_id in pending], workers)
+        else:
+            for part_id in pending:
+                self.export_part(part_id)
+        parts = self.get_export_parts()
+        if any(part["status"] != "done" for part in parts):
+            panic("Export is not finished, run it again to resume!", PANIC_INVALID_STATE)
+        rows = sum(part["rows"] for part in parts)
+        print_flush(f"Exported {rows} rows into {len(parts)} file(s) in '{spec['folder']}'")
+        self.drop_export()
+        return rows
+
+    def plan_export(self, spec):
+        query = export_filter(spec["years"], spec["regions"])
+        manifest = sorted(self.get_manifest().values(), key=lambda entry: (entry["year"] or 0, entry["_id"]))
+        headers = [entry["header"] for entry in manifest
+                   if entry.get("header") and (not spec["years"] or entry["year"] in spec["years"])]
+
+        @db_session(transaction=False)
+        def _plan_export(session, db):
             target_collection = self.get_target_collection(session, db)
-            result = target_collection.aggregate([
-                {"$match": {"$or": [{"year": 2019}, {"year": 2020}], "PHYSTESTSTATUS": "Зараховано"}},
-                {"$group": {
-                    "_id": {
-                        "year": "$year",
-                        "REGNAME": "$REGNAME",
-                    },
-                    "max_ball": {"$max": "$PHYSBALL100"}
-                }}
-            ])
-            stats = dict()
-            for r in result:
-                if r["_id"]["REGNAME"] not in stats:
-                    stats[r["_id"]["REGNAME"]] = dict()
-                stats[r["_id"]["REGNAME"]][r["_id"]["year"]] = float(r["max_ball"].replace(",", "."))
-            return stats
-        stats = _do_query(self)
-        with open(os.path.join(self.fs.query_folder, "query_result.csv"), "w") as f:
-            f.write("Region,MaxPhysBall100_2019,MaxPhysBall100_2020\n")
-            for s in stats.items():
-                f.write(f"{s[0]},{s[1].get(2019)},{s[1].get(2020)}\n")
-        print_flush(" done!")
+            columns = order_columns([c["_id"] for c in DbOperation(session, db).aggregate(
+                target_collection, columns_pipeline(query), "GET EXPORT COLUMNS")], headers)
+            if spec["partition"] == "year":
+                years = [y["_id"] for y in DbOperation(session, db).aggregate(
+                    target_collection, years_pipeline(query), "GET EXPORT YEARS")]
+                ranges = [("none" if year is None else year, dict(year=year)) for year in years]
+            else:
+                ids = [d["_id"] for d in DbOperation(session, db).aggregate(
+                    target_collection, id_sample_pipeline(query, spec["parts"]), "SAMPLE EXPORT IDS")]
+                ranges = [(f"{i:04d}", dict(id_min=id_min, id_max=id_max))
+                          for i, (id_min, id_max) in enumerate(get_id_bounds(ids, spec["parts"]))]
+            if not columns or not ranges:
+                return
+            DbOperation(session, db).insert_data(self.get_export_collection(session, db), [dict(
+                _id=part,
+                part=part,
+                partition=spec["partition"],
+                path=get_export_path(spec["folder"], self.target_collection_name, key, spec["format"],
+                                     spec["encoding"], spec["compression"]),
+                status="pending",
+                last_id=None,
+                rows=0,
+                file_size=0,
+                spec=dict(spec, columns=columns),
+                **bounds) for part, (key, bounds) in enumerate(ranges)], "FILL EXPORT COLLECTION", use_session=False)
+
+        _plan_export(self)
+
+    def export_part(self, part_id, show_progress=True):
+        @db_session(transaction=False)
+        def _get_part(session, db):
+            return self.get_export_collection(session, db).find_one({"_id": part_id})
+
+        entry = _get_part(self)
+        if entry is None or entry["status"] == "done":
+            return
+        spec, path = entry["spec"], entry["path"]
+        if entry["file_size"] and (not os.path.exists(path) or os.path.getsize(path) < entry["file_size"]):
+            print_flush(f"Export file '{path}' is missing or truncated, restarting part {part_id}")
+            entry.update(last_id=None, rows=0, file_size=0)
+        query = partition_filter(export_filter(spec["years"], spec["regions"]), entry, entry["last_id"])
+        batch_size = get_env_int("EXPORT_BATCH_SIZE", 1000)
+        title = f"Exporting part {part_id} into '{path}'"
+        if show_progress:
+            print_flush(f"{title}: ", end='')
+        else:
+            print_flush(f"{title}: started")
+        METRICS.reset(f"export:{part_id}")
+
+        @db_session(transaction=False)
+        def _export_part(session, db):
+            export_collection = self.get_export_collection(session, db)
+            cursor = self.get_target_collection(session, db).find(
+                query, sort=[("_id", pymongo.ASCENDING)], batch_size=batch_size, session=session)
+            rows = entry["rows"]
+            with ExportWriter(path, spec["format"], spec["columns"], spec["encoding"], spec["compression"],
+                              entry["file_size"]) as writer:
+                while True:
+                    with METRICS.timer("read"):
+                        batch = list(islice(cursor, batch_size))
+                    if not batch:
+                        break
+                    with METRICS.timer("write"):
+                        writer.write(batch)
+                    rows += len(batch)
+                    METRICS.add(rows=len(batch), done_bytes=writer.size - entry["file_size"])
+                    entry["file_size"] = writer.size
+                    DbOperation(session, db).update_fields(export_collection, {"_id": part_id}, {
+                        "$set": {"last_id": batch[-1]["_id"], "rows": rows, "file_size": writer.size}},
+                        "UPDATE EXPORT CHECKPOINT")
+                    if show_progress:
+                        rows_per_s, _ = METRICS.progress()
+                        print_flush(f"\r{title}: {rows} rows, {format_file_size(writer.size)} "
+                                    f"({rows_per_s:.0f} rows/s)", end="")
+                DbOperation(session, db).update_fields(export_collection, {"_id": part_id}, {
+                    "$set": {"status": "done", "rows": rows, "file_size": writer.size}}, "FINISH EXPORT PART")
+            return rows
+
+        with MetricsReporter():
+            rows = _export_part(self)
+        if show_progress:
+            print_flush(f"\r\x1b[1K\r{title}: done! {rows} rows")
+        else:
+            print_flush(f"{title}: done! {rows} rows")
+
+
+def get_aux_entries(files):
+    return [{
+        "file_name": file,
+        "year": year,
+        "file_seek": 0,
+        "header": "",
+        "planned": False,
+        "tr_id": 0}
+        for file, year in files]
+
+
+def get_file_filter(file_name):
+    return {"_id": {"$regex": f"^{re.escape(get_datafile_name(file_name))}:"}}
+
+
+def populate_part(file_name, part, memory_budget):
+    use_env_files()
+    populate = Populate()
+    populate.memory_budget = memory_budget
+    with populate:
+        populate.populate_part(file_name, part, show_progress=False)
+    finish_profiler()
+
+
+def export_part(part_id):
+    use_env_files()
+    populate = Populate()
+    with populate:
+        populate.export_part(part_id, show_progress=False)
@@ -0,0 +1,149 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from user import get_env, get_env_int, get_env_choice, print_flush
+
+PROFILE_MODES = ["off", "sample", "cprofile"]
+SUMMARY_LIMIT = 25
+
+
+def get_code_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.own = Counter()
+        self.total = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(get_code_name(frame.f_code))
+                    frame = frame.f_back
+                thread_name = names.get(thread_id, str(thread_id))
+                self.stacks[";".join([thread_name] + stack[::-1])] += 1
+                self.own[(thread_name, stack[0])] += 1
+                for name in set(stack):
+                    self.total[(thread_name, name)] += 1
+            self.samples += 1
+
+    def dump(self, path):
+        with open(f"{path}.folded", "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f} ms", ""]
+        for title, counter in (("Own samples", self.own), ("Total samples", self.total)):
+            lines.append(f"{title}:")
+            for (thread_name, name), count in counter.most_common(SUMMARY_LIMIT):
+                lines.append(f"{count:8d} {count / max(self.samples, 1):7.1%}  [{thread_name}] {name}")
+            lines.append("")
+        with open(f"{path}.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+        return [f"{path}.folded", f"{path}.txt"]
+
+
+class DeterministicProfiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(f"{path}.prof")
+        summary = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=summary)
+        stats.sort_stats("tottime").print_stats(SUMMARY_LIMIT)
+        stats.sort_stats("cumulative").print_stats(SUMMARY_LIMIT)
+        with open(f"{path}.txt", "w", encoding="utf-8") as f:
+            f.write(summary.getvalue())
+        return [f"{path}.prof", f"{path}.txt"]
+
+
+class Profiler:
+    def __init__(self, mode, batches, seconds, interval, folder):
+        self.mode = mode
+        self.batches = batches
+        self.seconds = seconds
+        self.folder = folder
+        self.profiler = SamplingProfiler(interval / 1000) if mode == "sample" else DeterministicProfiler()
+        self.state = "ready"
+        self.started = None
+        self.count = 0
+
+    @property
+    def running(self):
+        return self.state == "running"
+
+    def start(self):
+        if self.state != "ready":
+            return
+        print_flush(f"Profiling ({self.mode}) for {self.batches} batches or {self.seconds} s")
+        self.state = "running"
+        self.started = time.perf_counter()
+        self.profiler.start()
+
+    def tick(self):
+        if not self.running:
+            return
+        self.count += 1
+        if self.count >= self.batches or time.perf_counter() - self.started >= self.seconds:
+            self.finish()
+
+    def finish(self):
+        if not self.running:
+            return
+        self.profiler.stop()
+        self.state = "finished"
+        path = os.path.join(self.folder, f"profile_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}")
+        paths = self.profiler.dump(path)
+        print_flush(f"\nProfile of {self.count} batches written to {', '.join(paths)}")
+
+
+PROFILER = [None]
+
+
+def get_profiler():
+    if PROFILER[0] is None:
+        mode = get_env_choice("POPULATE_PROFILE", PROFILE_MODES, "off")
+        if mode == "off":
+            return None
+        PROFILER[0] = Profiler(mode,
+                               get_env_int("POPULATE_PROFILE_BATCHES", 100),
+                               get_env_int("POPULATE_PROFILE_SECONDS", 60),
+                               get_env_int("POPULATE_PROFILE_INTERVAL_MS", 5),
+                               get_env("QUERY_FOLDER", required=False) or ".")
+    return PROFILER[0]
+
+
+def finish_profiler():
+    if PROFILER[0] is not None:
+        PROFILER[0].finish()
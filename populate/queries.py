@@ -0,0 +1,155 @@
+import csv
+from itertools import islice
+
+from schema import decode_value, match_values, to_float, SUBJECTS
+
+PASSED_STATUS = "Зараховано"
+
+
+def physics_max_ball_pipeline():
+    return [
+        {"$match": {"year": {"$in": [2019, 2020]},
+                    "PHYSTESTSTATUS": {"$in": match_values("PHYSTESTSTATUS", PASSED_STATUS)}}},
+        {"$group": {
+            "_id": {
+                "year": "$year",
+                "REGNAME": "$REGNAME",
+            },
+            "max_ball": {"$max": "$PHYSBALL100"}
+        }},
+        {"$group": {
+            "_id": "$_id.REGNAME",
+            "max_ball_2019": {"$max": {"$cond": [{"$eq": ["$_id.year", 2019]}, "$max_ball", None]}},
+            "max_ball_2020": {"$max": {"$cond": [{"$eq": ["$_id.year", 2020]}, "$max_ball", None]}},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+def physics_max_ball_summary_pipeline():
+    return [
+        {"$match": {"_id.year": {"$in": [2019, 2020]}, "_id.subject": "PHYS",
+                    "_id.status": {"$in": match_values("PHYSTESTSTATUS", PASSED_STATUS)}}},
+        {"$group": {
+            "_id": "$_id.REGNAME",
+            "max_ball_2019": {"$max": {"$cond": [{"$eq": ["$_id.year", 2019]}, "$max", None]}},
+            "max_ball_2020": {"$max": {"$cond": [{"$eq": ["$_id.year", 2020]}, "$max", None]}},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+def physics_max_ball_row(r):
+    return [decode_value("REGNAME", r["_id"]), to_float(r["max_ball_2019"]), to_float(r["max_ball_2020"])]
+
+
+def subject_stats_pipeline():
+    return [
+        {"$project": {
+            "year": 1,
+            "subjects": [{"subject": subject, "status": f"${subject}TESTSTATUS", "ball": f"${subject}BALL100"}
+                         for subject in SUBJECTS],
+        }},
+        {"$unwind": "$subjects"},
+        {"$match": {"subjects.status": {"$in": match_values("TESTSTATUS", PASSED_STATUS)}}},
+        {"$group": {
+            "_id": {"year": "$year", "subject": "$subjects.subject"},
+            "count": {"$sum": 1},
+            "avg_ball": {"$avg": "$subjects.ball"},
+            "max_ball": {"$max": "$subjects.ball"},
+        }},
+        {"$sort": {"_id.year": 1, "_id.subject": 1}},
+    ]
+
+
+def subject_stats_summary_pipeline():
+    return [
+        {"$match": {"_id.status": {"$in": match_values("TESTSTATUS", PASSED_STATUS)}}},
+        {"$group": {
+            "_id": {"year": "$_id.year", "subject": "$_id.subject"},
+            "count": {"$sum": "$count"},
+            "ball_count": {"$sum": "$ball_count"},
+            "ball_sum": {"$sum": "$sum"},
+            "max_ball": {"$max": "$max"},
+        }},
+        {"$project": {
+            "count": 1,
+            "max_ball": 1,
+            "avg_ball": {"$cond": [{"$gt": ["$ball_count", 0]}, {"$divide": ["$ball_sum", "$ball_count"]}, None]},
+        }},
+        {"$sort": {"_id.year": 1, "_id.subject": 1}},
+    ]
+
+
+def subject_stats_row(r):
+    avg_ball = r["avg_ball"]
+    return [r["_id"]["year"], r["_id"]["subject"], r["count"],
+            None if avg_ball is None else round(avg_ball, 2), to_float(r["max_ball"])]
+
+
+def region_status_counts_pipeline():
+    return [
+        {"$match": {"PHYSTESTSTATUS": {"$exists": True}}},
+        {"$group": {
+            "_id": {"year": "$year", "REGNAME": "$REGNAME", "status": "$PHYSTESTSTATUS"},
+            "count": {"$sum": 1},
+        }},
+        {"$sort": {"_id.year": 1, "_id.REGNAME": 1, "_id.status": 1}},
+    ]
+
+
+def region_status_counts_summary_pipeline():
+    return [
+        {"$match": {"_id.subject": "PHYS"}},
+        {"$group": {
+            "_id": {"year": "$_id.year", "REGNAME": "$_id.REGNAME", "status": "$_id.status"},
+            "count": {"$sum": "$count"},
+        }},
+        {"$sort": {"_id.year": 1, "_id.REGNAME": 1, "_id.status": 1}},
+    ]
+
+
+def region_status_counts_row(r):
+    return [r["_id"]["year"], decode_value("REGNAME", r["_id"].get("REGNAME")),
+            decode_value("PHYSTESTSTATUS", r["_id"]["status"]), r["count"]]
+
+
+QUERIES = {
+    "phys_max_by_region": dict(
+        description="max PHYSBALL100 by region, 2019 vs 2020",
+        file_name="query_result.csv",
+        pipeline=physics_max_ball_pipeline,
+        summary_pipeline=physics_max_ball_summary_pipeline,
+        columns=["Region", "MaxPhysBall100_2019", "MaxPhysBall100_2020"],
+        row=physics_max_ball_row),
+    "subject_stats": dict(
+        description="count, average and max BALL100 by year and subject (passed tests)",
+        file_name="subject_stats.csv",
+        pipeline=subject_stats_pipeline,
+        summary_pipeline=subject_stats_summary_pipeline,
+        columns=["Year", "Subject", "Count", "AvgBall100", "MaxBall100"],
+        row=subject_stats_row),
+    "phys_status_by_region": dict(
+        description="PHYSTESTSTATUS counts by year and region",
+        file_name="phys_status_by_region.csv",
+        pipeline=region_status_counts_pipeline,
+        summary_pipeline=region_status_counts_summary_pipeline,
+        columns=["Year", "Region", "PhysTestStatus", "Count"],
+        row=region_status_counts_row),
+}
+DEFAULT_QUERY = "phys_max_by_region"
+
+
+def write_query_result(collection, pipeline, query, path, batch_size):
+    cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+    rows = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(query["columns"])
+        while True:
+            batch = list(islice(cursor, batch_size))
+            if not batch:
+                break
+            writer.writerows(query["row"](r) for r in batch)
+            rows += len(batch)
+    return rows
@@ -0,0 +1,196 @@
+import mmap
+import queue
+import threading
+from itertools import accumulate
+
+from datafiles import get_file_size, strip, STRIP_CHARS
+
+BLOCK_SIZE = 1 << 20
+READ_AHEAD = 4
+
+
+def read_header(file, encoding):
+    file.seek(0)
+    header_text = file.readline().decode(encoding).strip()
+    return header_text, file.tell()
+
+
+def read_chunks(file, block_size):
+    while True:
+        data = file.read(block_size)
+        if not data:
+            return
+        yield data
+
+
+def read_ahead(chunks, depth=READ_AHEAD):
+    chunk_queue = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=run, name="read-ahead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def read_blocks(file, file_seek, block_size=BLOCK_SIZE):
+    file.seek(file_seek)
+    block_start = file_seek
+    rest = b""
+    chunks = read_chunks(file, block_size)
+    if getattr(file, "compressed", False):
+        chunks = read_ahead(chunks)
+    for data in chunks:
+        data = rest + data
+        cut = data.rfind(b"\n") + 1
+        if cut == 0:
+            rest = data
+            continue
+        rest = data[cut:]
+        yield data[:cut], block_start
+        block_start += cut
+    if rest:
+        yield rest, block_start
+
+
+def read_blocks_mmap(file, file_seek, block_size=BLOCK_SIZE):
+    if get_file_size(file.name) == 0:
+        return
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        block_start, size = file_seek, len(mm)
+        while block_start < size:
+            block_end = mm.rfind(b"\n", block_start, block_start + block_size) + 1
+            if block_end == 0:
+                block_end = mm.find(b"\n", block_start + block_size) + 1
+            if block_end == 0:
+                block_end = size
+            yield mm[block_start:block_end], block_start
+            block_start = block_end
+
+
+READERS = {
+    "buffered": read_blocks,
+    "mmap": read_blocks_mmap,
+}
+
+
+def split_block(block, block_start):
+    lines = block.split(b"\n")
+    if block.endswith(b"\n"):
+        lines.pop()
+    line_ends = list(accumulate([len(line) + 1 for line in lines], initial=block_start))[1:]
+    line_ends[-1] = min(line_ends[-1], block_start + len(block))
+    return lines, line_ends
+
+
+def parse_legacy(blocks, header_len, encoding, file_seek, file_end=None):
+    offset = file_seek
+    prev_line_text = ""
+    for block, block_start in blocks:
+        for line, next_offset in zip(*split_block(block, block_start)):
+            if not prev_line_text and file_end is not None and offset >= file_end:
+                return
+            offset = next_offset
+            line_text = prev_line_text + line.decode(encoding).strip()
+            if not line_text:
+                return
+            fields = [strip(l) for l in line_text.rstrip().split(';')]
+            if len(fields) == header_len:
+                prev_line_text = ""
+                yield [fields], [offset]
+            else:
+                prev_line_text = line_text
+
+
+def parse_block(blocks, header_len, encoding, file_seek, file_end=None):
+    offset = file_seek
+    pending = None
+    for block, block_start in blocks:
+        texts = block.decode(encoding).split("\n")
+        _, line_ends = split_block(block, block_start)
+        records, offsets = [], []
+        for line_text, line_end in zip(texts, line_ends):
+            if pending is None and file_end is not None and offset >= file_end:
+                break
+            line_text = line_text.strip()
+            fields = line_text.split(';')
+            if pending is not None:
+                if line_text:
+                    pending[-1] += fields[0]
+                    pending.extend(fields[1:])
+                fields = pending
+            elif not line_text:
+                break
+            if len(fields) == header_len:
+                records.append([f.strip(STRIP_CHARS) for f in fields])
+                offsets.append(line_end)
+                pending = None
+                offset = line_end
+            else:
+                pending = fields
+        else:
+            if records:
+                yield records, offsets
+            continue
+        if records:
+            yield records, offsets
+        return
+
+
+PARSERS = {
+    "legacy": parse_legacy,
+    "block": parse_block,
+}
+
+
+def is_record_line(line, header_len, encoding):
+    return len(line.decode(encoding).strip().split(';')) == header_len
+
+
+def split_ranges(file, header_len, encoding, file_seek, file_size, parts):
+    bounds = [file_seek]
+    for i in range(1, parts):
+        cut = file_seek + (file_size - file_seek) * i // parts
+        if cut <= bounds[-1]:
+            continue
+        file.seek(cut - 1)
+        file.readline()
+        while True:
+            pos = file.tell()
+            line = file.readline()
+            if not line or is_record_line(line, header_len, encoding):
+                break
+        if pos >= file_size:
+            break
+        if pos > bounds[-1]:
+            bounds.append(pos)
+    return list(zip(bounds, bounds[1:] + [None]))
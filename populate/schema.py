@@ -0,0 +1,111 @@
+NULL_VALUES = {"", "null"}
+NUMBER_SUFFIXES = ("BALL100", "BALL12", "BALL", "ADAPTSCALE")
+NUMBER_COLUMNS = {"BIRTH"}
+
+REGIONS = ["Вінницька область", "Волинська область", "Дніпропетровська область", "Донецька область",
+           "Житомирська область", "Закарпатська область", "Запорізька область", "Івано-Франківська область",
+           "Київська область", "Кіровоградська область", "Луганська область", "Львівська область",
+           "Миколаївська область", "Одеська область", "Полтавська область", "Рівненська область",
+           "Сумська область", "Тернопільська область", "Харківська область", "Херсонська область",
+           "Хмельницька область", "Черкаська область", "Чернівецька область", "Чернігівська область",
+           "м.Київ", "Автономна Республіка Крим", "м.Севастополь"]
+STATUSES = ["Зараховано", "Не з'явився", "Не подолав поріг", "Анульовано", "Не зараховано"]
+SEX_TYPES = ["чоловіча", "жіноча"]
+SUBJECTS = ["UKR", "HIST", "MATH", "PHYS", "CHEM", "BIO", "GEO", "ENG", "FRA", "DEU", "SPA"]
+
+REGION_CODES = {region: code for code, region in enumerate(REGIONS, 1)}
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES, 1)}
+SEX_CODES = {sex: code for code, sex in enumerate(SEX_TYPES, 1)}
+
+
+def to_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace(",", "."))
+    except ValueError:
+        return value
+
+
+def to_code(codes):
+    def convert(value):
+        return codes.get(value, value)
+
+    return convert
+
+
+def get_codes(column):
+    if column == "SEXTYPENAME":
+        return SEX_CODES
+    if column.endswith("REGNAME"):
+        return REGION_CODES
+    if column.endswith("TESTSTATUS"):
+        return STATUS_CODES
+    return None
+
+
+def get_converter(column):
+    if column in NUMBER_COLUMNS or column.endswith(NUMBER_SUFFIXES):
+        return to_number
+    codes = get_codes(column)
+    if codes is not None:
+        return to_code(codes)
+    return None
+
+
+def build_schema(header):
+    return [get_converter(h) for h in header]
+
+
+def make_values(values, schema):
+    return [None if v in NULL_VALUES else v if convert is None else convert(v) for v, convert in zip(values, schema)]
+
+
+class RowBatch:
+    def __init__(self, header):
+        self.header = header
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, values, row_id, year):
+        values.append(row_id)
+        values.append(year)
+        self.rows.append(values)
+
+    def document(self, values):
+        document = {h: v for h, v in zip(self.header, values) if v is not None}
+        document["_id"] = values[-2]
+        document["year"] = values[-1]
+        return document
+
+    def documents(self):
+        return [self.document(values) for values in self.rows]
+
+
+def encode_value(column, value):
+    convert = get_converter(column)
+    return value if convert is None else convert(value)
+
+
+def match_values(column, value):
+    code = encode_value(column, value)
+    return [value] if code == value else [value, code]
+
+
+def decode_value(column, value):
+    codes = get_codes(column)
+    if codes is not None and isinstance(value, int):
+        for name, code in codes.items():
+            if code == value:
+                return name
+    return value
+
+
+def to_float(value):
+    if isinstance(value, str):
+        return float(value.replace(",", "."))
+    return None if value is None else float(value)
@@ -0,0 +1,61 @@
+from itertools import product
+
+from bson.son import SON
+from pymongo.errors import OperationFailure
+
+from schema import REGIONS, encode_value
+from user import print_flush
+
+ALREADY_INITIALIZED = 23
+
+
+def parse_shard_key(text):
+    return [field.strip() for field in (text or "").split(",") if field.strip()]
+
+
+def get_shard_key_values(field, years, typed):
+    if field == "year":
+        return sorted({year for year in years if year is not None})
+    if field == "REGNAME":
+        return sorted(encode_value(field, region) if typed else region for region in REGIONS)
+    return None
+
+
+def get_split_points(shard_key, years, typed):
+    values = [get_shard_key_values(field, years, typed) for field in shard_key]
+    if any(v is None for v in values):
+        return []
+    return [SON(zip(shard_key, point)) for point in product(*values)][1:]
+
+
+def split_by_shard_key(rows, shard_key):
+    groups = dict()
+    for row in rows:
+        groups.setdefault(tuple(row.get(field) for field in shard_key), []).append(row)
+    return list(groups.values())
+
+
+def shard_collection(client, collection, shard_key, split_points):
+    admin = client.admin
+    try:
+        admin.command("enableSharding", collection.database.name)
+    except OperationFailure as e:
+        if e.code != ALREADY_INITIALIZED:
+            raise
+    admin.command("shardCollection", collection.full_name, key=SON((field, 1) for field in shard_key))
+    if not split_points:
+        return 0
+    shards = [shard["_id"] for shard in admin.command("listShards")["shards"]]
+    for i, point in enumerate(split_points):
+        print_flush(f"\r\x1b[1K\rPre-splitting chunks: {i + 1} / {len(split_points)}", end="")
+        admin.command("split", collection.full_name, middle=point)
+    for i, point in enumerate(split_points):
+        shard = shards[(i + 1) % len(shards)]
+        print_flush(f"\r\x1b[1K\rDistributing chunks: {i + 1} / {len(split_points)}", end="")
+        try:
+            admin.command("moveChunk", collection.full_name, find=point, to=shard)
+        except OperationFailure as e:
+            if "already" not in str(e):
+                raise
+    print_flush(f"\r\x1b[1K\rPre-split into {len(split_points) + 1} chunks over {len(shards)} shards")
+    return len(split_points)
@@ -0,0 +1,71 @@
+from pymongo import UpdateOne
+
+from schema import SUBJECTS
+
+NUMBER_TYPES = ["double", "int", "long", "decimal"]
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def summary_key(year, region, subject, status):
+    return {"year": year, "REGNAME": region, "subject": subject, "status": status}
+
+
+def summarize_rows(rows):
+    summary = dict()
+    for row in rows:
+        for subject in SUBJECTS:
+            status = row.get(f"{subject}TESTSTATUS")
+            if status is None:
+                continue
+            key = (row["year"], row.get("REGNAME"), subject, status)
+            stats = summary.get(key)
+            if stats is None:
+                stats = summary[key] = [0, 0, 0, None, None]
+            stats[0] += 1
+            ball = row.get(f"{subject}BALL100")
+            if is_number(ball):
+                stats[1] += 1
+                stats[2] += ball
+                stats[3] = ball if stats[3] is None else min(stats[3], ball)
+                stats[4] = ball if stats[4] is None else max(stats[4], ball)
+    return summary
+
+
+def summary_requests(rows):
+    requests = []
+    for key, (count, ball_count, ball_sum, ball_min, ball_max) in summarize_rows(rows).items():
+        update = {"$inc": {"count": count, "ball_count": ball_count, "sum": ball_sum}}
+        if ball_min is not None:
+            update["$min"] = {"min": ball_min}
+            update["$max"] = {"max": ball_max}
+        requests.append(UpdateOne({"_id": summary_key(*key)}, update, upsert=True))
+    return requests
+
+
+def summary_rebuild_pipeline(summary_collection_name, years=None):
+    ball = "$subjects.ball"
+    number_ball = {"$cond": [{"$in": [{"$type": ball}, NUMBER_TYPES]}, ball, None]}
+    match = [] if years is None else [{"$match": {"year": {"$in": list(years)}}}]
+    return match + [
+        {"$project": {
+            "year": 1,
+            "REGNAME": {"$ifNull": ["$REGNAME", None]},
+            "subjects": [{"subject": subject, "status": f"${subject}TESTSTATUS", "ball": f"${subject}BALL100"}
+                         for subject in SUBJECTS],
+        }},
+        {"$unwind": "$subjects"},
+        {"$match": {"subjects.status": {"$ne": None}}},
+        {"$group": {
+            "_id": summary_key("$year", "$REGNAME", "$subjects.subject", "$subjects.status"),
+            "count": {"$sum": 1},
+            "ball_count": {"$sum": {"$cond": [{"$in": [{"$type": ball}, NUMBER_TYPES]}, 1, 0]}},
+            "sum": {"$sum": ball},
+            "min": {"$min": number_ball},
+            "max": {"$max": number_ball},
+        }},
+        {"$merge": {"into": summary_collection_name, "on": "_id",
+                    "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
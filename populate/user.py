@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 
@@ -32,6 +33,54 @@ def get_env(var_name, required=True):
     return value
 
 
+def get_env_int(var_name, default):
+    value = get_env(var_name, required=False)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        panic(f"Environment variable '{var_name}' must be an integer, got '{value}'!", PANIC_ENV_VAR_INVALID)
+
+
+SIZE_UNITS = {"B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(text)
+
+
+def get_env_size(var_name, default):
+    value = get_env(var_name, required=False)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return parse_size(value)
+    except ValueError:
+        panic(f"Environment variable '{var_name}' must be a size like 512MB, got '{value}'!", PANIC_ENV_VAR_INVALID)
+
+
+def get_env_bool(var_name, default):
+    value = get_env(var_name, required=False)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_env_choice(var_name, choices, default):
+    value = get_env(var_name, required=False)
+    if value is None or value.strip() == "":
+        return default
+    if value not in choices:
+        panic(f"Environment variable '{var_name}' must be one of: {', '.join(choices)}, got '{value}'!",
+              PANIC_ENV_VAR_INVALID)
+    return value
+
+
 def print_err(message):
     print_flush(message, file=sys.stderr)
 
@@ -46,6 +95,10 @@ def is_panic():
 PANIC_ENV_VAR_NOT_DEFINED = 1
 PANIC_DATA_FOLDER_DOESNT_EXIST = 2
 PANIC_DB_ERROR_OCCURRED = 3
+PANIC_ENV_VAR_INVALID = 4
+PANIC_INVALID_STATE = 5
+PANIC_DATAFILE_INVALID = 6
+PANIC_DEPENDENCY_MISSING = 7
 
 
 def panic(message, exitcode):
@@ -54,6 +107,28 @@ def panic(message, exitcode):
     sys.exit(exitcode)
 
 
+class WorkerPanic(Exception):
+    def __str__(self):
+        return f"Worker process exited with code {self.args[0]}"
+
+
+def run_task(func, args):
+    try:
+        return func(*args)
+    except Exception:
+        raise
+    except BaseException as e:
+        raise WorkerPanic(e.code if isinstance(e, SystemExit) else 1) from None
+
+
+def run_workers(func, tasks, workers):
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        try:
+            return pool.starmap(run_task, [(func, args) for args in tasks], chunksize=1)
+        except WorkerPanic as e:
+            panic(f"{e}, see the error above!", e.args[0])
+
+
 def command_error(name, e, command, data):
     panic(f"Error occurred during execution of command '{name}':\n"
           f"\n{e}\n"